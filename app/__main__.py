@@ -13,6 +13,7 @@ logger = setup_logger(__name__)
 
 async def main():
     """Main function"""
+    bot = None
     try:
         # Initialize bot
         bot = TelegramBot()
@@ -28,9 +29,11 @@ async def main():
         await asyncio.get_event_loop().run_forever()
         
     except Exception as e:
-        logger.error(f"Error in main: {e}", exc_info=True)
+        logger.error("Error in main: %s", e, exc_info=True)
         raise
     finally:
+        if bot is not None:
+            await bot.stop()
         if settings.ENABLE_METRICS:
             await metrics.stop()
 
@@ -41,5 +44,5 @@ if __name__ == "__main__":
     except KeyboardInterrupt:
         logger.info("Bot stopped by user")
     except Exception as e:
-        logger.error(f"Fatal error: {e}", exc_info=True)
+        logger.error("Fatal error: %s", e, exc_info=True)
         raise 
\ No newline at end of file
@@ -1,22 +1,46 @@
+import asyncio
+import bisect
+import io
+import logging
+import threading
 import time
-from datetime import datetime, timedelta
-from typing import Dict, List, Optional
-from collections import defaultdict
+from datetime import datetime
+from typing import Deque, Dict, List, Optional
+from collections import Counter, defaultdict, deque
 import json
 import os
+try:
+    import orjson
+except ImportError:  # orjson is optional, fall back to stdlib json
+    orjson = None
 from app.logger import setup_logger
 from app.config import settings
 
 logger = setup_logger(__name__)
 
+# Length of the user activity window in seconds
+ACTIVITY_WINDOW = 86400.0
+
+# Number of most recent measurements kept per operation
+PERFORMANCE_HISTORY_SIZE = 1000
+
+def _performance_buffer(values=()) -> Deque[float]:
+    return deque(values, maxlen=PERFORMANCE_HISTORY_SIZE)
+
 class Analytics:
     def __init__(self):
-        self.command_stats: Dict[str, int] = defaultdict(int)
-        self.user_activity: Dict[int, List[datetime]] = defaultdict(list)
-        self.error_stats: Dict[str, int] = defaultdict(int)
-        self.performance_metrics: Dict[str, List[float]] = defaultdict(list)
-        self.last_save = time.time()
+        self.command_stats: Counter = Counter()
+        self.user_activity: Dict[int, Deque[float]] = defaultdict(deque)
+        self.error_stats: Counter = Counter()
+        self.performance_metrics: Dict[str, Deque[float]] = defaultdict(_performance_buffer)
+        # Running sum of the buffered durations per operation
+        self._performance_sums: Dict[str, float] = defaultdict(float)
+        self.last_save = time.monotonic()
         self.save_interval = 300  # 5 minutes
+        self._save_lock = threading.Lock()
+        self._analytics_dir = os.path.join(settings.DATA_DIR, 'analytics')
+        os.makedirs(self._analytics_dir, exist_ok=True)
+        self._analytics_path = os.path.join(self._analytics_dir, 'analytics.json')
         
         # Load existing data
         self.load_analytics()
@@ -28,13 +52,13 @@ class Analytics:
     
     def track_user_activity(self, user_id: int):
         """Track user activity"""
-        self.user_activity[user_id].append(datetime.now())
+        now = time.time()
+        cutoff = now - ACTIVITY_WINDOW
+        activity = self.user_activity[user_id]
+        activity.append(now)
         # Keep only last 24 hours
-        cutoff = datetime.now() - timedelta(days=1)
-        self.user_activity[user_id] = [
-            dt for dt in self.user_activity[user_id]
-            if dt > cutoff
-        ]
+        while activity and activity[0] < cutoff:
+            activity.popleft()
         self._auto_save()
     
     def track_error(self, error_type: str):
@@ -44,118 +68,156 @@ class Analytics:
     
     def track_performance(self, operation: str, duration: float):
         """Track operation duration"""
-        self.performance_metrics[operation].append(duration)
-        # Keep only last 1000 measurements
-        if len(self.performance_metrics[operation]) > 1000:
-            self.performance_metrics[operation] = self.performance_metrics[operation][-1000:]
+        durations = self.performance_metrics[operation]
+        if len(durations) == durations.maxlen:
+            # Oldest measurement is about to be dropped by the bounded buffer
+            self._performance_sums[operation] -= durations[0]
+        durations.append(duration)
+        self._performance_sums[operation] += duration
         self._auto_save()
     
     def get_active_users_24h(self) -> int:
         """Get number of active users in last 24 hours"""
-        cutoff = datetime.now() - timedelta(days=1)
+        cutoff = time.time() - ACTIVITY_WINDOW
         return sum(
             1 for activities in self.user_activity.values()
-            if any(dt > cutoff for dt in activities)
+            if activities and activities[-1] >= cutoff
         )
     
     def get_popular_commands(self, limit: int = 10) -> List[tuple]:
         """Get most popular commands"""
-        return sorted(
-            self.command_stats.items(),
-            key=lambda x: x[1],
-            reverse=True
-        )[:limit]
+        return self.command_stats.most_common(limit)
     
     def get_average_performance(self) -> Dict[str, float]:
         """Get average duration for each operation"""
         return {
-            op: sum(durations) / len(durations)
+            op: self._performance_sums[op] / len(durations)
             for op, durations in self.performance_metrics.items()
             if durations
         }
     
     def generate_report(self) -> str:
         """Generate analytics report"""
-        report = []
-        report.append("=== Bot Analytics Report ===")
+        report = io.StringIO()
+        write = report.write
+        write("=== Bot Analytics Report ===\n")
         
         # Active users
         active_users = self.get_active_users_24h()
-        report.append(f"\nActive Users (24h): {active_users}")
+        write(f"\nActive Users (24h): {active_users}\n")
         
         # Popular commands
-        popular_commands = self.get_popular_commands(5)
-        report.append("\nPopular Commands:")
-        for cmd, count in popular_commands:
-            report.append(f"  {cmd}: {count} uses")
+        write("\nPopular Commands:\n")
+        for cmd, count in self.get_popular_commands(5):
+            write(f"  {cmd}: {count} uses\n")
         
         # Error statistics
-        report.append("\nError Statistics:")
+        write("\nError Statistics:\n")
         for error_type, count in self.error_stats.items():
-            report.append(f"  {error_type}: {count} occurrences")
+            write(f"  {error_type}: {count} occurrences\n")
         
         # Performance metrics
-        avg_performance = self.get_average_performance()
-        report.append("\nAverage Performance:")
-        for op, avg_duration in avg_performance.items():
-            report.append(f"  {op}: {avg_duration:.3f} seconds")
+        write("\nAverage Performance:")
+        for op, avg_duration in self.get_average_performance().items():
+            write(f"\n  {op}: {avg_duration:.3f} seconds")
         
-        return "\n".join(report)
+        return report.getvalue()
     
     def _auto_save(self):
-        """Auto-save analytics data periodically"""
-        current_time = time.time()
-        if current_time - self.last_save > self.save_interval:
-            self.save_analytics()
-            self.last_save = current_time
+        """Auto-save analytics data periodically without blocking the event loop"""
+        current_time = time.monotonic()
+        if current_time - self.last_save <= self.save_interval:
+            return
+        self.last_save = current_time
+        
+        # Copy on the loop, serialize and write in a worker thread
+        data = self._snapshot()
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            # Not inside the event loop, nothing to block
+            self._write_data(data)
+            return
+        loop.run_in_executor(None, self._write_data, data)
     
     def save_analytics(self):
         """Save analytics data to file"""
-        try:
-            analytics_dir = os.path.join(settings.DATA_DIR, 'analytics')
-            os.makedirs(analytics_dir, exist_ok=True)
-            
-            data = {
-                'command_stats': dict(self.command_stats),
-                'user_activity': {
-                    user_id: [dt.isoformat() for dt in times]
-                    for user_id, times in self.user_activity.items()
-                },
-                'error_stats': dict(self.error_stats),
-                'performance_metrics': dict(self.performance_metrics)
+        self._write_data(self._snapshot())
+    
+    def _snapshot(self) -> dict:
+        """Copy analytics state for serialization, must run on the event loop thread"""
+        return {
+            'command_stats': dict(self.command_stats),
+            'user_activity': {
+                user_id: list(times)
+                for user_id, times in self.user_activity.items()
+            },
+            'error_stats': dict(self.error_stats),
+            'performance_metrics': {
+                op: list(durations)
+                for op, durations in self.performance_metrics.items()
             }
+        }
+    
+    def _write_data(self, data: dict):
+        """Write analytics data to file atomically, safe to call from a worker thread"""
+        try:
+            if orjson is not None:
+                payload = orjson.dumps(data, option=orjson.OPT_NON_STR_KEYS)
+            else:
+                payload = json.dumps(data, ensure_ascii=False).encode('utf-8')
             
-            file_path = os.path.join(analytics_dir, 'analytics.json')
-            with open(file_path, 'w', encoding='utf-8') as f:
-                json.dump(data, f, ensure_ascii=False, indent=2)
+            file_path = self._analytics_path
+            tmp_path = file_path + '.tmp'
+            with self._save_lock:
+                # Write the whole payload to a temp file, then atomically swap it in
+                fd = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+                with os.fdopen(fd, 'wb', buffering=1 << 20) as f:
+                    f.write(payload)
+                os.replace(tmp_path, file_path)
             
-            logger.debug("Analytics data saved successfully")
+            if logger.isEnabledFor(logging.DEBUG):
+                logger.debug("Analytics data saved successfully")
             
         except Exception as e:
-            logger.error(f"Error saving analytics data: {e}")
+            logger.error("Error saving analytics data: %s", e)
     
     def load_analytics(self):
         """Load analytics data from file"""
         try:
-            file_path = os.path.join(settings.DATA_DIR, 'analytics', 'analytics.json')
-            if not os.path.exists(file_path):
+            if not os.path.exists(self._analytics_path):
                 return
             
-            with open(file_path, 'r', encoding='utf-8') as f:
-                data = json.load(f)
+            with open(self._analytics_path, 'rb') as f:
+                raw = f.read()
+            data = orjson.loads(raw) if orjson is not None else json.loads(raw)
             
-            self.command_stats = defaultdict(int, data.get('command_stats', {}))
-            self.user_activity = defaultdict(list, {
-                int(user_id): [datetime.fromisoformat(dt) for dt in times]
-                for user_id, times in data.get('user_activity', {}).items()
+            self.command_stats = Counter(data.get('command_stats', {}))
+            self.user_activity = defaultdict(deque)
+            cutoff = time.time() - ACTIVITY_WINDOW
+            for user_id, times in data.get('user_activity', {}).items():
+                if times and isinstance(times[0], str):
+                    # Older files stored ISO timestamps instead of epoch floats
+                    times = [datetime.fromisoformat(t).timestamp() for t in times]
+                # Timestamps are appended in order, skip the expired prefix
+                recent = times[bisect.bisect_left(times, cutoff):]
+                if recent:
+                    self.user_activity[int(user_id)] = deque(recent)
+            self.error_stats = Counter(data.get('error_stats', {}))
+            self.performance_metrics = defaultdict(_performance_buffer, {
+                op: _performance_buffer(durations)
+                for op, durations in data.get('performance_metrics', {}).items()
+            })
+            self._performance_sums = defaultdict(float, {
+                op: sum(durations)
+                for op, durations in self.performance_metrics.items()
             })
-            self.error_stats = defaultdict(int, data.get('error_stats', {}))
-            self.performance_metrics = defaultdict(list, data.get('performance_metrics', {}))
             
-            logger.debug("Analytics data loaded successfully")
+            if logger.isEnabledFor(logging.DEBUG):
+                logger.debug("Analytics data loaded successfully")
             
         except Exception as e:
-            logger.error(f"Error loading analytics data: {e}")
+            logger.error("Error loading analytics data: %s", e)
 
 # Create global analytics instance
 analytics = Analytics() 
\ No newline at end of file
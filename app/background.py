@@ -1,6 +1,6 @@
 import asyncio
-from typing import Dict, Callable, Awaitable, Optional, Any
-from datetime import datetime
+from dataclasses import dataclass
+from typing import Dict, Callable, Awaitable, Optional, Any, Set
 import time
 from app.logger import setup_logger
 from app.config import settings
@@ -8,12 +8,18 @@ from app.analytics import analytics
 
 logger = setup_logger(__name__)
 
+@dataclass(slots=True)
+class TaskRecord:
+    task: asyncio.Task
+    callback: Optional[Callable]
+    start_time: float
+    result: Any = None
+
 class BackgroundTaskManager:
     def __init__(self):
-        self.tasks: Dict[str, asyncio.Task] = {}
-        self.results: Dict[str, Any] = {}
-        self.callbacks: Dict[str, Callable] = {}
-        self.start_times: Dict[str, float] = {}
+        self.tasks: Dict[str, TaskRecord] = {}
+        # Ids of finished tasks, filled by done callbacks
+        self._done_ids: Set[str] = set()
     
     async def add_task(
         self,
@@ -38,8 +44,8 @@ class BackgroundTaskManager:
         
         # Create task wrapper
         async def task_wrapper():
-            start_time = time.time()
-            self.start_times[task_id] = start_time
+            start_time = time.monotonic()
+            record.start_time = start_time
             
             try:
                 if timeout:
@@ -47,47 +53,42 @@ class BackgroundTaskManager:
                 else:
                     result = await coro
                 
-                self.results[task_id] = result
+                record.result = result
                 if callback:
                     callback(result)
                 
                 # Track performance
-                duration = time.time() - start_time
+                duration = time.monotonic() - start_time
                 analytics.track_performance(f"background_task_{task_id}", duration)
                 
             except asyncio.TimeoutError:
-                logger.error(f"Task {task_id} timed out after {timeout} seconds")
+                logger.error("Task %s timed out after %s seconds", task_id, timeout)
                 analytics.track_error(f"task_timeout_{task_id}")
             except Exception as e:
-                logger.error(f"Error in background task {task_id}: {e}")
+                logger.error("Error in background task %s: %s", task_id, e)
                 analytics.track_error(f"task_error_{task_id}")
-            finally:
-                # Cleanup
-                self._remove_task(task_id)
         
         # Create and start task
         task = asyncio.create_task(task_wrapper())
-        self.tasks[task_id] = task
-        self.callbacks[task_id] = callback
+        task.add_done_callback(lambda _task, tid=task_id: self._done_ids.add(tid))
+        record = TaskRecord(task=task, callback=callback, start_time=time.monotonic())
+        self.tasks[task_id] = record
         
-        logger.info(f"Started background task {task_id}")
+        logger.info("Started background task %s", task_id)
     
     def get_task_status(self, task_id: str) -> dict:
         """Get status of background task"""
-        if task_id not in self.tasks:
+        record = self.tasks.get(task_id)
+        if record is None:
             return {
                 'status': 'not_found',
                 'result': None,
                 'duration': None
             }
         
-        task = self.tasks[task_id]
-        start_time = self.start_times.get(task_id)
-        current_time = time.time()
-        
-        if task.done():
-            status = 'completed' if not task.exception() else 'failed'
-            result = self.results.get(task_id)
+        if record.task.done():
+            status = 'completed' if not record.task.exception() else 'failed'
+            result = record.result
         else:
             status = 'running'
             result = None
@@ -95,45 +96,42 @@ class BackgroundTaskManager:
         return {
             'status': status,
             'result': result,
-            'duration': current_time - start_time if start_time else None
+            'duration': time.monotonic() - record.start_time
         }
     
     def cancel_task(self, task_id: str):
         """Cancel background task"""
-        if task_id in self.tasks:
-            self.tasks[task_id].cancel()
-            self._remove_task(task_id)
-            logger.info(f"Cancelled task {task_id}")
+        record = self.tasks.pop(task_id, None)
+        if record is not None:
+            record.task.cancel()
+            logger.info("Cancelled task %s", task_id)
     
     def _remove_task(self, task_id: str):
         """Remove task and its associated data"""
         self.tasks.pop(task_id, None)
-        self.results.pop(task_id, None)
-        self.callbacks.pop(task_id, None)
-        self.start_times.pop(task_id, None)
     
     def _cleanup_tasks(self):
         """Remove completed tasks"""
-        completed_tasks = [
-            task_id for task_id, task in self.tasks.items()
-            if task.done()
-        ]
-        for task_id in completed_tasks:
-            self._remove_task(task_id)
+        for task_id in self._done_ids:
+            record = self.tasks.get(task_id)
+            # Id may have been reused by a task that is still running
+            if record is not None and record.task.done():
+                self._remove_task(task_id)
+        self._done_ids.clear()
     
     async def stop_all(self):
         """Stop all background tasks"""
-        for task_id in list(self.tasks.keys()):
+        # Snapshot before cancel_task removes entries from self.tasks
+        pending = list(self.tasks.items())
+        for task_id, _ in pending:
             self.cancel_task(task_id)
         
         # Wait for all tasks to complete
-        if self.tasks:
-            await asyncio.gather(*self.tasks.values(), return_exceptions=True)
+        if pending:
+            await asyncio.gather(*(record.task for _, record in pending), return_exceptions=True)
         
         self.tasks.clear()
-        self.results.clear()
-        self.callbacks.clear()
-        self.start_times.clear()
+        self._done_ids.clear()
         
         logger.info("All background tasks stopped")
 
@@ -1,17 +1,72 @@
 from telethon import TelegramClient, events
 from telethon.sessions import MemorySession
 import asyncio
+import heapq
+import random
+import re
+import time
+from collections import OrderedDict
+from functools import wraps
 from .config import settings
 from .logger import setup_logger
+from .monitoring import metrics
 from .session import SessionManager
 from .handlers import MessageHandlers
 from .user_session import UserSession
-from telethon.errors import FloodWaitError
+from .ratelimit import telegram_bucket
+from telethon.errors import (
+    AccessTokenInvalidError,
+    AuthKeyError,
+    FloodWaitError,
+    UnauthorizedError,
+)
 from telethon import connection
 import os
 
 logger = setup_logger(__name__)
 
+# Single pattern for all bot commands, matched once per incoming message
+COMMAND_PATTERN = re.compile(r'^/(start|help|auth|manual)\b')
+
+HELP_TEXT = (
+    "📁 Smart Folders Bot\n\n"
+    "/start - авторизация и список папок\n"
+    "/auth API_ID API_HASH - авторизация через API credentials\n"
+    "/manual - инструкция по ручной авторизации\n"
+    "/help - эта справка"
+)
+
+def is_plain_message(event) -> bool:
+    """Event filter that lets Telethon skip command messages before dispatch"""
+    text = event.raw_text
+    return not (text and text[0] == '/')
+
+ERROR_TEXT = "❌ Произошла ошибка. Попробуйте позже."
+
+def safe_handler(err_msg: str = ERROR_TEXT):
+    """Log handler errors and tell the user instead of letting them escape"""
+    def decorator(func):
+        @wraps(func)
+        async def wrapper(self, event, *args, **kwargs):
+            try:
+                return await func(self, event, *args, **kwargs)
+            except FloodWaitError as e:
+                # Telegram refuses further requests now, responding would fail too
+                logger.warning("Flood wait of %s seconds in %s", e.seconds, func.__name__)
+            except Exception:
+                logger.exception("Error in %s", func.__name__)
+                if settings.ENABLE_METRICS:
+                    metrics.increment_errors()
+                try:
+                    await event.respond(err_msg)
+                except Exception as e:
+                    logger.warning("Could not report error to user: %s", e)
+        return wrapper
+    return decorator
+
+# Errors that retrying cannot fix
+UNRECOVERABLE_ERRORS = (AccessTokenInvalidError, AuthKeyError, UnauthorizedError)
+
 class TelegramBot:
     def __init__(self):
         """Initialize bot instance"""
@@ -25,8 +80,19 @@ class TelegramBot:
             api_id=settings.API_ID,
             api_hash=settings.API_HASH
         )
-        self.users = {}
+        # Ordered from least to most recently used
+        self.users: OrderedDict[int, UserSession] = OrderedDict()
+        self._disconnect_tasks = set()
+        # Maintained by UserSession.is_authorized setter
+        self.authorized_count = 0
+        # Heap of (next check time, user_id) for connection checks
+        self._check_heap = []
+        self._check_scheduled = {}
+        # Set when a check is scheduled or a client disconnects
+        self._needs_check = asyncio.Event()
+        self._connection_checker = None
         self.session_manager = SessionManager()
+        self._session_writer = None
         self.handlers = None
     
     async def setup(self):
@@ -50,75 +116,271 @@ class TelegramBot:
             
             # Connect and start bot
             await self.bot.connect()
-            await self.bot.start(bot_token=settings.BOT_TOKEN)
+            await telegram_bucket.call(self.bot.start, bot_token=settings.BOT_TOKEN)
+            
+            self.handlers = MessageHandlers(self)
+            
+            # Session files are written in the background, off the handlers' path
+            if self._session_writer is None or self._session_writer.done():
+                self._session_writer = asyncio.create_task(self.session_manager.run_writer())
+            if self._connection_checker is None or self._connection_checker.done():
+                self._connection_checker = asyncio.create_task(self.check_connections())
             
             # Register handlers
-            self.bot.add_event_handler(self.handle_start, events.NewMessage(pattern='/start'))
-            self.bot.add_event_handler(self.handle_help, events.NewMessage(pattern='/help'))
-            self.bot.add_event_handler(self.handle_auth, events.NewMessage(pattern='/auth'))
-            self.bot.add_event_handler(self.handle_message, events.NewMessage)
+            self.bot.add_event_handler(
+                self.dispatch_command,
+                events.NewMessage(pattern=COMMAND_PATTERN)
+            )
+            self.bot.add_event_handler(
+                self.handle_message,
+                events.NewMessage(func=is_plain_message)
+            )
+            self.bot.add_event_handler(self.dispatch_callback, events.CallbackQuery)
             
             logger.info("Bot initialization completed successfully")
             
         except Exception as e:
-            logger.error(f"Error during bot initialization: {e}")
+            logger.error("Error during bot initialization: %s", e)
             raise
     
-    async def get_user_session(self, user_id: int) -> UserSession:
+    async def stop(self):
+        """Stop connection checks and disconnect watchers"""
+        tasks = list(self._disconnect_tasks)
+        if self._connection_checker is not None:
+            tasks.append(self._connection_checker)
+            self._connection_checker = None
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+    
+    @safe_handler()
+    async def dispatch_command(self, event):
+        """Route bot commands matched by COMMAND_PATTERN"""
+        command = event.pattern_match.group(1)
+        user_session = self.get_user_session(event.sender_id)
+        
+        if command == 'start':
+            if user_session.is_authorized:
+                await self.handlers.show_folders(event, user_session)
+            else:
+                await self.handlers.start_auth_process(event, user_session)
+        elif command == 'help':
+            await event.respond(HELP_TEXT)
+        elif command == 'auth':
+            await self.handlers.handle_auth_command(event, user_session)
+        elif command == 'manual':
+            await self.handlers.handle_manual_auth(event, user_session)
+    
+    @safe_handler()
+    async def dispatch_callback(self, event):
+        """Route inline button callbacks by their data prefix"""
+        data = event.data
+        user_session = self.get_user_session(event.sender_id)
+        
+        if data.startswith(b'folder_'):
+            await self.handlers.handle_folder_selection(event, user_session)
+        elif data.startswith(b'page_'):
+            await self.handlers.show_folders(event, user_session, page=int(data[5:]))
+    
+    @safe_handler()
+    async def handle_message(self, event):
+        """Handle regular (non-command) messages"""
+        user_session = self.get_user_session(event.sender_id)
+        if user_session.awaiting_auth_choice:
+            await self.handlers.handle_auth_choice(event, user_session)
+    
+    def get_user_session(self, user_id: int) -> UserSession:
         """Get or create user session with improved error handling"""
         try:
-            if user_id not in self.users:
-                self.users[user_id] = UserSession(user_id, self)
-            return self.users[user_id]
+            session = self.users.get(user_id)
+            if session is None:
+                session = self.users[user_id] = UserSession(user_id, self)
+                self._evict_sessions()
+            else:
+                self.users.move_to_end(user_id)
+            session.last_activity = time.monotonic()
+            return session
         except Exception as e:
-            logger.error(f"Error getting user session: {e}", exc_info=True)
+            logger.error("Error getting user session: %s", e, exc_info=True)
             raise
     
+    def _evict_sessions(self):
+        """Drop least recently used sessions above MAX_USER_SESSIONS"""
+        excess = len(self.users) - settings.MAX_USER_SESSIONS
+        if excess <= 0:
+            return
+        
+        # Authorized sessions own forwarding handlers and are never evicted
+        victims = []
+        for user_id, session in self.users.items():
+            if len(victims) >= excess:
+                break
+            if not session.is_authorized:
+                victims.append(user_id)
+        for user_id in victims:
+            self._drop_session(user_id)
+    
+    def _evict_idle_sessions(self):
+        """Drop unauthorized sessions idle for longer than SESSION_TIMEOUT"""
+        cutoff = time.monotonic() - settings.SESSION_TIMEOUT
+        for user_id, session in tuple(self.users.items()):
+            if session.last_activity >= cutoff:
+                break
+            if not session.is_authorized:
+                self._drop_session(user_id)
+    
+    def _drop_session(self, user_id: int):
+        """Remove session and disconnect its client in the background"""
+        session = self.users.pop(user_id, None)
+        if session is None or not session.client:
+            return
+        task = asyncio.create_task(session.client.disconnect())
+        self._disconnect_tasks.add(task)
+        task.add_done_callback(self._disconnect_tasks.discard)
+    
+    def schedule_connection_check(self, user_id: int, delay: float = 0.0):
+        """Queue a connection check for the user unless an earlier one is already scheduled"""
+        due = asyncio.get_running_loop().time() + delay
+        scheduled = self._check_scheduled.get(user_id)
+        if scheduled is not None and scheduled <= due:
+            return
+        # An earlier check replaces the later one, whose heap entry goes stale
+        self._check_scheduled[user_id] = due
+        heapq.heappush(self._check_heap, (due, user_id))
+        self._needs_check.set()
+    
+    def watch_disconnect(self, session: UserSession):
+        """Check the session's connection as soon as its client disconnects"""
+        self.unwatch_disconnect(session)
+        client = session.client
+        
+        async def watcher():
+            try:
+                # Shielded so cancelling the watcher leaves the client's future alone
+                await asyncio.shield(client.disconnected)
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                pass
+            if session.is_authorized and self.users.get(session.user_id) is session:
+                logger.warning("Client of user %s disconnected", session.user_id)
+                self.schedule_connection_check(session.user_id)
+        
+        task = asyncio.create_task(watcher())
+        session.disconnect_watcher = task
+        self._disconnect_tasks.add(task)
+        task.add_done_callback(self._disconnect_tasks.discard)
+    
+    def unwatch_disconnect(self, session: UserSession):
+        """Stop watching the session's client, for disconnects the bot makes itself"""
+        task = session.disconnect_watcher
+        if task is not None:
+            session.disconnect_watcher = None
+            task.cancel()
+    
     async def check_connections(self):
-        """Periodically check and maintain connections"""
+        """Check connections when they are due or a client disconnects"""
+        semaphore = asyncio.Semaphore(settings.CONNECTION_CHECK_CONCURRENCY)
+        
+        async def guarded_check(user_id, session):
+            async with semaphore:
+                healthy = await self._check_user_connection(user_id, session)
+            # Healthy sessions are checked rarely, flaky ones keep the short interval
+            delay = (
+                settings.CONNECTION_CHECK_HEALTHY_INTERVAL if healthy
+                else settings.CONNECTION_CHECK_INTERVAL
+            )
+            if session.is_authorized and self.users.get(user_id) is session:
+                self.schedule_connection_check(user_id, delay)
+        
+        loop = asyncio.get_running_loop()
+        heap = self._check_heap
+        needs_check = self._needs_check
         while True:
+            needs_check.clear()
+            self._evict_idle_sessions()
+            
+            if not self.authorized_count:
+                # Nothing to check until a session gets authorized
+                timeout = settings.CONNECTION_CHECK_IDLE_INTERVAL
+            else:
+                try:
+                    # Pop only the sessions that are due
+                    now = loop.time()
+                    due = []
+                    while heap and heap[0][0] <= now:
+                        when, user_id = heapq.heappop(heap)
+                        if self._check_scheduled.get(user_id) != when:
+                            continue  # replaced by an earlier check
+                        del self._check_scheduled[user_id]
+                        session = self.users.get(user_id)
+                        # Sessions authorized again later are rescheduled by the setter
+                        if session is not None and session.is_authorized:
+                            due.append((user_id, session))
+                    
+                    if due:
+                        results = await asyncio.gather(
+                            *(guarded_check(user_id, session) for user_id, session in due),
+                            return_exceptions=True
+                        )
+                        for (user_id, _), result in zip(due, results):
+                            if isinstance(result, Exception):
+                                logger.error("Connection check failed for user %s: %s", user_id, result)
+                except Exception as e:
+                    logger.error("Error in connection check: %s", e, exc_info=True)
+                
+                # Sleep until the next check is due, a new one is scheduled or a client disconnects
+                next_due = heap[0][0] - loop.time() if heap else settings.CONNECTION_CHECK_HEALTHY_INTERVAL
+                timeout = min(max(0.0, next_due), settings.CONNECTION_CHECK_HEALTHY_INTERVAL)
+            
+            try:
+                await asyncio.wait_for(needs_check.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+    
+    async def _check_user_connection(self, user_id: int, session: UserSession) -> bool:
+        """Check and restore connection of a single user, return True if it was healthy"""
+        try:
+            # Check connection state
+            was_connected = bool(session.client) and session.client.is_connected()
+            if not was_connected:
+                logger.warning("Detected disconnection for user %s", user_id)
+                if not await session.ensure_connected():
+                    logger.warning("Failed to restore connection for user %s", user_id)
+                    return False
+            
+            # Check authorization
             try:
-                for user_id, session in self.users.items():
-                    if session.is_authorized:
-                        try:
-                            # Check connection state
-                            if not session.client or not session.client.is_connected():
-                                logger.warning(f"Detected disconnection for user {user_id}")
-                                if not await session.ensure_connected():
-                                    logger.warning(f"Failed to restore connection for user {user_id}")
-                                    continue
-                            
-                            # Check authorization
-                            try:
-                                if not await session.client.is_user_authorized():
-                                    logger.warning(f"Detected authorization loss for user {user_id}")
-                                    session.is_authorized = False
-                                    if not await session.init_client():
-                                        logger.error(f"Failed to reinitialize client for user {user_id}")
-                                        continue
-                            except Exception as e:
-                                logger.error(f"Error checking authorization for user {user_id}: {e}")
-                                continue
-                            
-                            # Check functionality with simple request
-                            try:
-                                me = await session.client.get_me()
-                                if not me:
-                                    logger.warning(f"Failed to get user info for {user_id}")
-                                    if not await session.init_client():
-                                        logger.error(f"Failed to reinitialize client for user {user_id}")
-                            except Exception as e:
-                                logger.error(f"Error checking functionality for user {user_id}: {e}")
-                                if not await session.init_client():
-                                    logger.error(f"Failed to reinitialize client for user {user_id}")
-                                
-                        except Exception as e:
-                            logger.error(f"Error checking user {user_id}: {e}")
-                            
+                if not await session.client.is_user_authorized():
+                    logger.warning("Detected authorization loss for user %s", user_id)
+                    session.is_authorized = False
+                    if not await session.init_client():
+                        logger.error("Failed to reinitialize client for user %s", user_id)
+                    return False
             except Exception as e:
-                logger.error(f"Error in connection check: {e}", exc_info=True)
+                logger.error("Error checking authorization for user %s: %s", user_id, e)
+                return False
+            
+            # Check functionality with simple request
+            try:
+                me = await self.handlers.get_user_bucket(user_id).call(session.client.get_me)
+                if not me:
+                    logger.warning("Failed to get user info for %s", user_id)
+                    if not await session.init_client():
+                        logger.error("Failed to reinitialize client for user %s", user_id)
+                    return False
+            except Exception as e:
+                logger.error("Error checking functionality for user %s: %s", user_id, e)
+                if not await session.init_client():
+                    logger.error("Failed to reinitialize client for user %s", user_id)
+                return False
+            
+            # A reconnect above still counts as a problem
+            return was_connected
                 
-            await asyncio.sleep(30)  # Check every 30 seconds
+        except Exception as e:
+            logger.error("Error checking user %s: %s", user_id, e)
+            return False
     
     async def run(self):
         """Run the bot"""
@@ -133,23 +395,38 @@ class TelegramBot:
                     break
                     
                 except FloodWaitError as e:
+                    # Bucket retries already ran out, slow all further calls down
+                    telegram_bucket.decrease_rate()
                     wait_time = e.seconds
                     minutes = wait_time // 60
                     seconds = wait_time % 60
                     logger.warning(
-                        f"Hit rate limit on attempt {attempt + 1}/{max_retries}. "
-                        f"Waiting {minutes} minutes and {seconds} seconds before retry..."
+                        "Hit rate limit on attempt %s/%s. "
+                        "Waiting %s minutes and %s seconds before retry...",
+                        attempt + 1, max_retries, minutes, seconds
                     )
                     await asyncio.sleep(wait_time)
                     
+                except UNRECOVERABLE_ERRORS as e:
+                    logger.error("Unrecoverable error running bot: %s", e)
+                    raise
+                    
                 except Exception as e:
                     if attempt < max_retries - 1:
-                        logger.error(f"Error on attempt {attempt + 1}/{max_retries}: {e}")
-                        await asyncio.sleep(retry_delay)
+                        # Exponential backoff with jitter so instances don't retry in lockstep
+                        delay = min(
+                            settings.RETRY_MAX_DELAY,
+                            retry_delay * (2 ** attempt) * (1 + random.random() * 0.5)
+                        )
+                        logger.error(
+                            "Error on attempt %s/%s: %s. Retrying in %.1f seconds",
+                            attempt + 1, max_retries, e, delay
+                        )
+                        await asyncio.sleep(delay)
                     else:
-                        logger.error(f"Critical error running bot: {e}")
+                        logger.error("Critical error running bot: %s", e)
                         raise
                         
         except Exception as e:
-            logger.error(f"Critical error running bot: {e}")
+            logger.error("Critical error running bot: %s", e)
             raise 
\ No newline at end of file
@@ -1,64 +1,224 @@
 import asyncio
+import gzip
+import hashlib
+import hmac
+import logging
+import pickle
 import time
-from typing import Optional, Any, Callable
+from collections import OrderedDict
+from typing import Optional, Any, Callable, Dict, Hashable
 from functools import wraps
 from app.config import settings
 from app.logger import setup_logger
 
+try:
+    import redis.asyncio as aioredis
+except ImportError:
+    aioredis = None
+
 logger = setup_logger(__name__)
 
+# Redis values are signed so only this bot's processes can make us unpickle them;
+# anyone able to sign already holds the bot token
+_REMOTE_SIGNING_KEY = hashlib.sha256(b'cache:' + settings.BOT_TOKEN.encode()).digest()
+_DIGEST_SIZE = hashlib.sha256().digest_size
+
+def _sign(payload: bytes) -> bytes:
+    return hmac.new(_REMOTE_SIGNING_KEY, payload, hashlib.sha256).digest()
+
+def _now_ms() -> int:
+    """Monotonic clock in integer milliseconds"""
+    return time.monotonic_ns() // 1_000_000
+
 class AsyncLRUCache:
-    def __init__(self, ttl: int = 300):
-        self.cache = {}
+    """TTL and LRU cache for use from the bot's event loop thread only"""
+    
+    def __init__(self, ttl: int = 300, maxsize: Optional[int] = None):
+        # Ordered from least to most recently used
+        self.cache: OrderedDict = OrderedDict()
         self.ttl = ttl
-        self.lock = asyncio.Lock()
+        self.ttl_ms = int(ttl * 1000)
+        self.maxsize = maxsize or settings.CACHE_MAX_SIZE
+        self._next_sweep_ms = _now_ms() + self.ttl_ms // 2
+        # Pending loads shared by concurrent callers of the same key
+        self.inflight: Dict[Hashable, asyncio.Future] = {}
+        # Optional shared second tier that survives restarts
+        self.redis = None
+        if settings.ENABLE_REDIS_CACHE and settings.REDIS_URL:
+            if aioredis is None:
+                logger.warning("ENABLE_REDIS_CACHE is set but the redis package is not installed")
+            else:
+                self.redis = aioredis.from_url(
+                    settings.REDIS_URL, max_connections=20, decode_responses=False
+                )
     
-    async def get(self, key: str) -> Optional[Any]:
+    def get(self, key: Hashable) -> Optional[Any]:
         """Get value from cache if not expired"""
-        async with self.lock:
-            if key in self.cache:
-                value, timestamp = self.cache[key]
-                if time.time() - timestamp <= self.ttl:
-                    return value
-                else:
-                    del self.cache[key]
-        return None
+        # Plain dict operations are atomic on the event loop, no lock needed
+        entry = self.cache.get(key)
+        if entry is None:
+            return None
+        value, deadline_ms = entry
+        if deadline_ms < _now_ms():
+            self.cache.pop(key, None)
+            return None
+        self.cache.move_to_end(key)
+        return value
+    
+    def set(self, key: Hashable, value: Any):
+        """Set value in cache with its expiry deadline"""
+        now_ms = _now_ms()
+        if now_ms > self._next_sweep_ms:
+            self._sweep(now_ms)
+        
+        self.cache[key] = (value, now_ms + self.ttl_ms)
+        self.cache.move_to_end(key)
+        # Evict least recently used entries above the size limit
+        while len(self.cache) > self.maxsize:
+            self.cache.popitem(last=False)
     
-    async def set(self, key: str, value: Any):
-        """Set value in cache with current timestamp"""
-        async with self.lock:
-            self.cache[key] = (value, time.time())
+    def _sweep(self, now_ms: int):
+        """Drop expired entries so they don't count against maxsize"""
+        expired = [
+            key for key, (_, deadline_ms) in self.cache.items()
+            if deadline_ms < now_ms
+        ]
+        for key in expired:
+            del self.cache[key]
+        self._next_sweep_ms = now_ms + self.ttl_ms // 2
     
-    async def delete(self, key: str):
+    def delete(self, key: Hashable):
         """Delete key from cache"""
-        async with self.lock:
-            self.cache.pop(key, None)
+        self.cache.pop(key, None)
+    
+    async def get_remote(self, key: Hashable) -> Optional[Any]:
+        """Get value from Redis and keep it in memory, None on miss or error"""
+        remote_key = _remote_key(key)
+        if self.redis is None or remote_key is None:
+            return None
+        try:
+            raw = await self.redis.get(remote_key)
+            if raw is None:
+                return None
+            signature, payload = raw[:_DIGEST_SIZE], raw[_DIGEST_SIZE:]
+            if not hmac.compare_digest(signature, _sign(payload)):
+                logger.warning("Ignoring Redis cache entry with a bad signature")
+                return None
+            value = pickle.loads(gzip.decompress(payload))
+        except Exception as e:
+            logger.warning("Redis cache read failed: %s", e)
+            return None
+        self.set(key, value)
+        return value
+    
+    async def set_remote(self, key: Hashable, value: Any):
+        """Store value in Redis with the cache TTL"""
+        remote_key = _remote_key(key)
+        if self.redis is None or remote_key is None:
+            return
+        try:
+            payload = gzip.compress(pickle.dumps(value), 1)
+            await self.redis.setex(remote_key, self.ttl, _sign(payload) + payload)
+        except Exception as e:
+            logger.warning("Redis cache write failed: %s", e)
     
     async def clear(self):
         """Clear all cache"""
-        async with self.lock:
-            self.cache.clear()
+        self.cache.clear()
 
-def async_cached(ttl: Optional[int] = None):
-    """Decorator for async function caching"""
+def _make_key(name: str, args: tuple, kwargs: dict) -> Hashable:
+    """Build a hashable cache key without formatting the arguments"""
+    key = (name, args, tuple(sorted(kwargs.items()))) if kwargs else (name, args)
+    try:
+        hash(key)
+    except TypeError:
+        # Unhashable containers are keyed by their contents, raises TypeError
+        # for other unhashable arguments
+        key = (
+            name,
+            tuple(_freeze(arg) for arg in args),
+            tuple(sorted((k, _freeze(v)) for k, v in kwargs.items()))
+        )
+    return key
+
+def _freeze(value: Any) -> Hashable:
+    """Hashable stand-in for value that is equal for equal contents"""
+    if isinstance(value, dict):
+        return (dict, frozenset((k, _freeze(v)) for k, v in value.items()))
+    if isinstance(value, (list, tuple)):
+        return (type(value), tuple(_freeze(item) for item in value))
+    if isinstance(value, (set, frozenset)):
+        return (type(value), frozenset(_freeze(item) for item in value))
+    hash(value)
+    return value
+
+def _is_stable(value: Any) -> bool:
+    if isinstance(value, tuple):
+        return all(_is_stable(item) for item in value)
+    return value is None or isinstance(value, (str, int, float, bytes))
+
+def _remote_key(key: Hashable) -> Optional[str]:
+    """Redis key for plain-value keys, None for keys of in-process objects"""
+    # Arbitrary objects and frozen containers have no repr that is stable across processes
+    if not _is_stable(key):
+        return None
+    return f"cache:{key!r}"
+
+def async_cached(ttl: Optional[int] = None, key_func: Optional[Callable[..., Hashable]] = None):
+    """Decorator for async function caching, keyed by key_func(*args, **kwargs) if given"""
     def decorator(func):
         cache = AsyncLRUCache(ttl or settings.CACHE_TTL)
         
         @wraps(func)
         async def wrapper(*args, **kwargs):
             # Create cache key from function name and arguments
-            key = f"{func.__name__}:{args}:{kwargs}"
+            try:
+                if key_func is not None:
+                    key = _make_key(func.__qualname__, (key_func(*args, **kwargs),), {})
+                else:
+                    key = _make_key(func.__qualname__, args, kwargs)
+            except TypeError:
+                # Arguments with no content-based key are not cached
+                return await func(*args, **kwargs)
             
             # Try to get from cache
-            cached_value = await cache.get(key)
+            cached_value = cache.get(key)
             if cached_value is not None:
-                logger.debug(f"Cache hit for {key}")
+                if logger.isEnabledFor(logging.DEBUG):
+                    logger.debug("Cache hit for %s", key)
                 return cached_value
             
+            cached_value = await cache.get_remote(key)
+            if cached_value is not None:
+                return cached_value
+            
+            # Join an identical call that is already running
+            pending = cache.inflight.get(key)
+            if pending is not None:
+                return await asyncio.shield(pending)
+            
             # If not in cache, call function and cache result
-            result = await func(*args, **kwargs)
-            await cache.set(key, result)
-            logger.debug(f"Cache miss for {key}, value cached")
+            future = asyncio.get_running_loop().create_future()
+            cache.inflight[key] = future
+            try:
+                result = await func(*args, **kwargs)
+            except asyncio.CancelledError:
+                future.cancel()
+                raise
+            except Exception as e:
+                future.set_exception(e)
+                # Mark as retrieved in case nobody else was waiting
+                future.exception()
+                raise
+            finally:
+                if cache.inflight.get(key) is future:
+                    del cache.inflight[key]
+            
+            cache.set(key, result)
+            future.set_result(result)
+            await cache.set_remote(key, result)
+            if logger.isEnabledFor(logging.DEBUG):
+                logger.debug("Cache miss for %s, value cached", key)
             return result
         
         # Add cache control methods to wrapper
@@ -68,7 +228,3 @@ def async_cached(ttl: Optional[int] = None):
         
         return wrapper
     return decorator
-
-# Create global caches for common data
-folder_cache = AsyncLRUCache(settings.FOLDER_CACHE_TTL)
-user_cache = AsyncLRUCache(settings.CACHE_TTL) 
\ No newline at end of file
@@ -1,6 +1,7 @@
 from pydantic import Field
 from pydantic_settings import BaseSettings
 import os
+from functools import cached_property, lru_cache
 from typing import Optional
 
 class Settings(BaseSettings):
@@ -12,19 +13,20 @@ class Settings(BaseSettings):
     # Directory Settings
     DATA_DIR: str = Field("./data", description="Base directory for data storage")
 
-    @property
+    # Directory paths are derived once, DATA_DIR does not change at runtime
+    @cached_property
     def LOGS_DIR(self) -> str:
         return os.path.join(self.DATA_DIR, "logs")
 
-    @property
+    @cached_property
     def USER_DATA_DIR(self) -> str:
         return os.path.join(self.DATA_DIR, "user_data")
 
-    @property
+    @cached_property
     def ANALYTICS_DIR(self) -> str:
         return os.path.join(self.DATA_DIR, "analytics")
 
-    @property
+    @cached_property
     def BACKUPS_DIR(self) -> str:
         return os.path.join(self.DATA_DIR, "backups")
     
@@ -32,6 +34,13 @@ class Settings(BaseSettings):
     WEBHOOK_URL: Optional[str] = Field(None, description="Webhook URL for bot updates")
     WEBHOOK_HOST: str = Field("0.0.0.0", description="Webhook server host")
     WEBHOOK_PORT: int = Field(8443, description="Webhook server port")
+    MAX_RECONNECT_ATTEMPTS: int = Field(3, description="Maximum bot start attempts")
+    RETRY_DELAY: float = Field(1.0, description="Base delay between bot start attempts in seconds")
+    RETRY_MAX_DELAY: float = Field(30.0, description="Maximum delay between bot start attempts in seconds")
+    CONNECTION_CHECK_INTERVAL: int = Field(30, description="User connection check interval in seconds")
+    CONNECTION_CHECK_HEALTHY_INTERVAL: int = Field(300, description="Connection check interval for healthy sessions")
+    CONNECTION_CHECK_IDLE_INTERVAL: int = Field(120, description="Connection check interval when no users are authorized")
+    CONNECTION_CHECK_CONCURRENCY: int = Field(16, description="Maximum concurrent user connection checks")
     
     # Security Settings
     ENCRYPTION_KEY: Optional[str] = Field(None, description="Key for session encryption")
@@ -49,11 +58,17 @@ class Settings(BaseSettings):
     # Queue Settings
     QUEUE_MAX_SIZE: int = Field(1000, description="Maximum queue size per channel")
     QUEUE_TIMEOUT: int = Field(60, description="Queue processing timeout in seconds")
-    FORWARD_DELAY: float = Field(0.5, description="Delay between forwards in seconds")
+    FORWARD_DELAY: float = Field(0.5, description="Minimum interval between forwards into one channel in seconds")
+    FORWARD_RATE_LIMIT: float = Field(30.0, description="Maximum forward requests per second per user account")
+    FORWARD_BATCH_WINDOW: float = Field(0.2, description="Time to collect messages into one forward in seconds")
+    FORWARD_BATCH_SIZE: int = Field(100, description="Maximum messages per forward request")
     
     # Cache Settings
     CACHE_TTL: int = Field(300, description="Cache TTL in seconds")
     FOLDER_CACHE_TTL: int = Field(300, description="Folder list cache TTL in seconds")
+    CACHE_MAX_SIZE: int = Field(10000, description="Maximum number of entries per cache")
+    DEDUP_CACHE_TTL: int = Field(60, description="How long forwarded messages are remembered for deduplication in seconds")
+    DEDUP_CACHE_SIZE: int = Field(10000, description="Maximum number of messages remembered for deduplication")
     ENABLE_REDIS_CACHE: bool = Field(False, description="Use Redis for caching")
     REDIS_URL: Optional[str] = Field(None, description="Redis connection URL")
     
@@ -82,6 +97,8 @@ class Settings(BaseSettings):
     # Background Tasks
     CLEANUP_INTERVAL: int = Field(3600, description="Cleanup interval in seconds")
     SESSION_TIMEOUT: int = Field(7 * 24 * 3600, description="Session timeout in seconds")
+    SESSION_SAVE_DELAY: float = Field(0.5, description="Time to collect session updates into one save in seconds")
+    MAX_USER_SESSIONS: int = Field(1000, description="Maximum number of user sessions kept in memory")
     
     # Rate Limiting
     RATE_LIMIT: int = Field(30, description="Rate limit per minute")
@@ -99,5 +116,10 @@ class Settings(BaseSettings):
                          self.ANALYTICS_DIR, self.BACKUPS_DIR]:
             os.makedirs(directory, exist_ok=True)
 
+@lru_cache(maxsize=1)
+def get_settings() -> Settings:
+    """Parse settings once per process"""
+    return Settings()
+
 # Create settings instance
-settings = Settings() 
\ No newline at end of file
+settings = get_settings() 
\ No newline at end of file
@@ -1,99 +1,206 @@
-from telethon import events, Button
+from telethon import events, utils, Button
 from telethon.tl.functions.messages import GetDialogFiltersRequest
 from telethon.tl.functions.channels import CreateChannelRequest
-from telethon.tl.types import DialogFilter
-from telethon.errors import FloodWaitError
+from telethon.tl.types import (
+    DialogFilter, InputPeerChannel, InputPeerChat, InputPeerUser, PeerChannel, PeerChat, PeerUser
+)
+from telethon.errors import ChannelPrivateError, FloodWaitError, MessageNotModifiedError
 import qrcode
 from io import BytesIO
+from functools import partial
+from itertools import islice
+from typing import Dict
 import asyncio
+import logging
+import random
 import time
+from collections import OrderedDict
 from app.logger import setup_logger
 from app.config import settings
-from app.cache import async_cached, folder_cache
+from app.cache import async_cached
 from app.queue_manager import MessageQueue
+from app.ratelimit import AdaptiveTokenBucket
 from app.monitoring import metrics
 from telethon.sync import TelegramClient
 from telethon.sessions import MemorySession
 
 logger = setup_logger(__name__)
 
+# Attempts to create a folder channel when Telegram asks to wait
+CREATE_CHANNEL_ATTEMPTS = 3
+# Flood-wait retries of one forwarded batch before it is dropped, on top of the bucket's own
+FORWARD_ATTEMPTS = 3
+# Upper bound of the random delay added to flood waits, so users don't retry in step
+FLOOD_WAIT_MAX_JITTER = 10
+
+# Number of folders per page of the folder list
+FOLDERS_PER_PAGE = 8
+
+def _make_qr_png(url: str) -> bytes:
+    """Render QR code for url as PNG bytes, CPU bound so run it in a thread"""
+    qr = qrcode.QRCode(version=1, box_size=10, border=5)
+    qr.add_data(url)
+    qr.make(fit=True)
+    img = qr.make_image(fill_color="black", back_color="white")
+    buffer = BytesIO()
+    # A two-colour image compresses well even at the fastest level
+    img.save(buffer, format='PNG', compress_level=1)
+    return buffer.getvalue()
+
+# Marked peer IDs, the same form as event.chat_id, for the common peer types
+_PEER_IDS = {
+    InputPeerChannel: lambda peer: -(1000000000000 + peer.channel_id),
+    PeerChannel: lambda peer: -(1000000000000 + peer.channel_id),
+    InputPeerChat: lambda peer: -peer.chat_id,
+    PeerChat: lambda peer: -peer.chat_id,
+    InputPeerUser: lambda peer: peer.user_id,
+    PeerUser: lambda peer: peer.user_id,
+}
+
+def _peer_id(peer) -> int:
+    """Get the marked ID of peer, one dict lookup instead of utils.get_peer_id's type checks"""
+    get_id = _PEER_IDS.get(type(peer))
+    if get_id is not None:
+        return get_id(peer)
+    return utils.get_peer_id(peer)
+
+def _user_key(handlers, user_session) -> int:
+    """Cache per-user results by user ID rather than by session object"""
+    return user_session.user_id
+
 class MessageHandlers:
+    __slots__ = (
+        'bot', 'message_queue', 'message_cache', 'cache_ttl', 'max_cache', '_cache_ttl_ns',
+        '_channel_buckets', '_user_buckets', '_keyboards',
+    )
+    
     def __init__(self, bot):
         self.bot = bot
         self.message_queue = MessageQueue()
-        self.message_cache = {}  # Cache for deduplication
-        self.cache_ttl = 60  # TTL for message cache in seconds
-        
-    def _get_message_key(self, message):
-        """Generate unique key for message deduplication"""
-        return f"{message.chat_id}:{message.id}:{int(time.time() / self.cache_ttl)}"
+        self.message_cache = OrderedDict()  # Cache for deduplication, oldest first
+        self.cache_ttl = settings.DEDUP_CACHE_TTL  # TTL for message cache in seconds
+        self.max_cache = settings.DEDUP_CACHE_SIZE
+        self._cache_ttl_ns = self.cache_ttl * 1_000_000_000
+        # Forward rate limits per destination channel and per user account
+        self._channel_buckets: Dict[int, AdaptiveTokenBucket] = {}
+        self._user_buckets: Dict[int, AdaptiveTokenBucket] = {}
+        # Rendered folder list pages per user, least recently used first
+        self._keyboards = OrderedDict()
         
     def _is_duplicate(self, message):
-        """Check if message is a duplicate"""
-        key = self._get_message_key(message)
-        if key in self.message_cache:
+        """Check if message was already seen within cache_ttl"""
+        # Message IDs are only unique within a chat
+        key = (message.chat_id, message.id)
+        cache = self.message_cache
+        now = time.monotonic_ns()
+        ttl_ns = self._cache_ttl_ns
+        seen_at = cache.get(key)
+        if seen_at is not None and now - seen_at < ttl_ns:
             return True
-        self.message_cache[key] = time.time()
-        # Cleanup old cache entries
-        current_time = time.time()
-        self.message_cache = {
-            k: v for k, v in self.message_cache.items()
-            if current_time - v < self.cache_ttl
-        }
+        cache[key] = now
+        # Keep entries in insertion time order
+        cache.move_to_end(key)
+        # Drop expired or excess entries from the old end
+        while cache and (
+            len(cache) > self.max_cache
+            or now - next(iter(cache.values())) >= ttl_ns
+        ):
+            cache.popitem(last=False)
         return False
         
-    @async_cached(ttl=settings.FOLDER_CACHE_TTL)
+    @async_cached(ttl=settings.FOLDER_CACHE_TTL, key_func=_user_key)
     async def get_dialog_filters(self, user_session):
         """Get dialog filters with caching"""
         return await user_session.client(GetDialogFiltersRequest())
+    
+    @async_cached(ttl=settings.FOLDER_CACHE_TTL, key_func=_user_key)
+    async def _get_valid_folders(self, user_session):
+        """Get folders that can be shown to the user, keyed by folder ID in display order"""
+        dialog_filters = await self.get_dialog_filters(user_session)
+        return {
+            f.id: f for f in dialog_filters.filters 
+            if isinstance(f, DialogFilter) and hasattr(f, 'id') and hasattr(f, 'title') and f.title
+        }
+        
+    def _folder_keyboard(self, user_session, folders_by_id, page):
+        """Get text and buttons for a folder list page, reused while folders and active set are unchanged"""
+        user_id = user_session.user_id
+        active = frozenset(user_session.active_folders)
+        keyboards = self._keyboards
+        entry = keyboards.get(user_id)
+        if entry is None or entry[0] is not folders_by_id or entry[1] != active:
+            entry = keyboards[user_id] = (folders_by_id, active, {})
+            while len(keyboards) > settings.MAX_USER_SESSIONS:
+                keyboards.popitem(last=False)
+        keyboards.move_to_end(user_id)
+        
+        pages = entry[2]
+        rendered = pages.get(page)
+        if rendered is None:
+            rendered = pages[page] = self._render_folder_page(folders_by_id, active, page)
+        return rendered
+    
+    def _update_folder_row(self, user_session, folders_by_id, page, previous, folder):
+        """Get a folder list page after toggling folder, reusing all other rows of previous"""
+        text, buttons = previous
+        data = f"folder_{folder.id}_{page}".encode()
+        status = "[✓]" if str(folder.id) in user_session.active_folders else "[ ]"
+        buttons = [
+            [Button.inline(f"{status} {folder.title}", data)] if row[0].data == data else row
+            for row in buttons
+        ]
+        active = frozenset(user_session.active_folders)
+        self._keyboards[user_session.user_id] = (folders_by_id, active, {page: (text, buttons)})
+        return text, buttons
+    
+    def _render_folder_page(self, folders_by_id, active, page):
+        total_pages = (len(folders_by_id) + FOLDERS_PER_PAGE - 1) // FOLDERS_PER_PAGE
+        
+        # Get folders for current page
+        start_idx = page * FOLDERS_PER_PAGE
+        end_idx = start_idx + FOLDERS_PER_PAGE
+        current_page_filters = islice(folders_by_id.values(), start_idx, end_idx)
+        
+        buttons = []
+        for folder in current_page_filters:
+            status = "[✓]" if str(folder.id) in active else "[ ]"
+            button_text = f"{status} {folder.title}"
+            buttons.append([Button.inline(button_text, f"folder_{folder.id}_{page}")])
+        
+        # Add navigation buttons
+        nav_buttons = []
+        if page > 0:
+            nav_buttons.append(Button.inline("◀️ Back", f"page_{page-1}"))
+        if page < total_pages - 1:
+            nav_buttons.append(Button.inline("Next ▶️", f"page_{page+1}"))
+        
+        if nav_buttons:
+            buttons.append(nav_buttons)
+        
+        text = f"Select folders to create channels (Page {page+1}/{total_pages}):"
+        return text, buttons
         
     async def show_folders(self, event, user_session, page=0):
         try:
-            dialog_filters = await self.get_dialog_filters(user_session)
-            page_size = 8  # Number of folders per page
-            
-            # Filter valid folders
-            valid_folders = [
-                f for f in dialog_filters.filters 
-                if isinstance(f, DialogFilter) and hasattr(f, 'id') and hasattr(f, 'title') and f.title
-            ]
-            
-            total_folders = len(valid_folders)
-            total_pages = (total_folders + page_size - 1) // page_size
+            folders_by_id = await self._get_valid_folders(user_session)
             
             # Update metrics
-            metrics.update_active_folders(total_folders)
-            
-            # Get folders for current page
-            start_idx = page * page_size
-            end_idx = start_idx + page_size
-            current_page_filters = valid_folders[start_idx:end_idx]
-            
-            buttons = []
-            for folder in current_page_filters:
-                folder_id_str = str(folder.id)
-                is_active = folder_id_str in user_session.active_folders
-                status = "[✓]" if is_active else "[ ]"
-                button_text = f"{status} {folder.title}"
-                buttons.append([Button.inline(button_text, f"folder_{folder.id}")])
+            metrics.update_active_folders(len(folders_by_id))
             
-            # Add navigation buttons
-            nav_buttons = []
-            if page > 0:
-                nav_buttons.append(Button.inline("◀️ Back", f"page_{page-1}"))
-            if page < total_pages - 1:
-                nav_buttons.append(Button.inline("Next ▶️", f"page_{page+1}"))
-            
-            if nav_buttons:
-                buttons.append(nav_buttons)
+            if not folders_by_id:
+                await event.respond("No folders available. Create a folder in Telegram and try again.")
+                return
             
-            # Store current page in event for reference
-            event.current_page = page
+            text, buttons = self._folder_keyboard(user_session, folders_by_id, page)
             
-            await event.respond(
-                f"Select folders to create channels (Page {page+1}/{total_pages}):",
-                buttons=buttons
-            )
+            if isinstance(event, events.CallbackQuery.Event):
+                # Replace the list the button belongs to instead of sending a new one
+                try:
+                    await event.edit(text, buttons=buttons)
+                except MessageNotModifiedError:
+                    pass
+            else:
+                await event.respond(text, buttons=buttons)
             
         except Exception as e:
             logger.error(f"Error showing folders: {e}")
@@ -102,40 +209,49 @@ class MessageHandlers:
     async def handle_folder_selection(self, event, user_session):
         """Handle folder selection callback"""
         try:
-            # Extract folder ID from callback data
-            folder_id = int(event.data.decode().split('_')[1])
-            
-            try:
-                # Answer callback immediately with empty response
-                await event.answer("")
-            except Exception as e:
-                logger.warning(f"Could not answer callback: {e}")
+            # Callback data is folder_<id>_<page>, older buttons lack the page
+            folder_id, _, page = event.data[7:].partition(b'_')
+            folder_id = int(folder_id)
+            page = int(page) if page else 0
             
             # Get folder info
-            dialog_filters = await self.get_dialog_filters(user_session)
-            selected_folder = next(
-                (f for f in dialog_filters.filters 
-                 if isinstance(f, DialogFilter) and hasattr(f, 'id') and f.id == folder_id),
-                None
-            )
+            folders_by_id = await self._get_valid_folders(user_session)
+            selected_folder = folders_by_id.get(folder_id)
             
             if not selected_folder:
-                await event.respond("Folder not found")
+                await event.answer("Folder not found", alert=True)
                 return
             
             try:
+                previous_active = frozenset(user_session.active_folders)
+                previous = self._folder_keyboard(user_session, folders_by_id, page)
+                
                 # Toggle folder activation
                 folder_id_str = str(folder_id)
+                folder_title = self._get_folder_title(selected_folder)
                 if folder_id_str in user_session.active_folders:
+                    # Deactivation makes no API calls, the result fits in the callback answer
                     await self.deactivate_folder(user_session, folder_id_str)
-                    await event.respond(f"Folder {selected_folder.title} deactivated")
+                    await self._answer_callback(event, f"Folder {folder_title} deactivated")
                 else:
-                    await self.activate_folder(user_session, selected_folder)
-                    await event.respond(f"Folder {selected_folder.title} activated")
+                    # Creating the channel may wait out flood limits for longer than
+                    # Telegram waits for the callback answer, so answer first
+                    await self._answer_callback(event, f"Activating folder {folder_title}…")
+                    if not await self.activate_folder(user_session, selected_folder):
+                        await event.respond(f"Failed to activate folder {folder_title}")
                 
-                # Update folder list
-                current_page = getattr(event, 'current_page', 0)
-                await self.show_folders(event, user_session, page=current_page)
+                # Update the folder list in place, only the toggled row changes
+                if frozenset(user_session.active_folders) ^ previous_active <= {folder_id_str}:
+                    text, buttons = self._update_folder_row(
+                        user_session, folders_by_id, page, previous, selected_folder
+                    )
+                else:
+                    # Other folders were toggled meanwhile
+                    text, buttons = self._folder_keyboard(user_session, folders_by_id, page)
+                try:
+                    await event.edit(text, buttons=buttons)
+                except MessageNotModifiedError:
+                    pass
                 
             except Exception as e:
                 logger.error(f"Error toggling folder {folder_id}: {e}")
@@ -148,10 +264,17 @@ class MessageHandlers:
             logger.error(f"Error handling folder selection: {e}")
             await event.respond("An error occurred while processing your request")
     
+    async def _answer_callback(self, event, notice):
+        try:
+            await event.answer(notice)
+        except Exception as e:
+            logger.warning(f"Could not answer callback: {e}")
+    
     async def activate_folder(self, user_session, folder):
         try:
+            folder_title = self._get_folder_title(folder)
             # Try to use existing channel first
-            channel = await self.get_or_create_channel(user_session, folder)
+            channel = await self.get_or_create_channel(user_session, folder, folder_title)
             if not channel:
                 return False
             
@@ -161,8 +284,12 @@ class MessageHandlers:
                 'title': folder.title
             }
             
+            await self.bot.session_manager.update_session(user_session.user_id, {
+                'active_folders': user_session.active_folders
+            })
+            
             # Setup message forwarding with queue
-            await self.setup_message_forwarding(user_session, folder, channel.id)
+            await self.setup_message_forwarding(user_session, folder, channel.id, folder_title)
             return True
             
         except Exception as e:
@@ -172,18 +299,15 @@ class MessageHandlers:
     async def deactivate_folder(self, user_session, folder_id_str):
         try:
             # Stop message queue processing
-            if folder_id_str in user_session.active_folders:
-                channel_id = user_session.active_folders[folder_id_str]['channel_id']
-                self.message_queue.stop_processing(channel_id)
-            
-            if folder_id_str in user_session.folder_handlers:
-                user_session.client.remove_event_handler(
-                    user_session.folder_handlers[folder_id_str]
-                )
-                del user_session.folder_handlers[folder_id_str]
+            entry = user_session.active_folders.pop(folder_id_str, None)
+            if entry:
+                self.message_queue.stop_processing(entry['channel_id'])
+                self._channel_buckets.pop(entry['channel_id'], None)
+                await self.bot.session_manager.update_session(user_session.user_id, {
+                    'active_folders': user_session.active_folders
+                })
             
-            if folder_id_str in user_session.active_folders:
-                del user_session.active_folders[folder_id_str]
+            self._remove_routes(user_session, folder_id_str)
                 
         except Exception as e:
             logger.error(f"Error deactivating folder: {e}")
@@ -196,114 +320,108 @@ class MessageHandlers:
             return str(folder.title)
         return "Unnamed folder"
 
-    async def get_or_create_channel(self, user_session, folder):
+    async def get_or_create_channel(self, user_session, folder, folder_title=None):
+        if folder_title is None:
+            folder_title = self._get_folder_title(folder)
         try:
             folder_id_str = str(folder.id)
-            folder_title = self._get_folder_title(folder)
-            data = self.bot.session_manager.load_session(user_session.user_id)
+            data = await self.bot.session_manager.load_session_async(user_session.user_id)
             folder_channels = data.get('folder_channels', {})
             
             if folder_id_str in folder_channels:
                 try:
                     channel_data = folder_channels[folder_id_str]
                     
-                    # Try to get channel through dialogs first
-                    channel = None
-                    async for dialog in user_session.client.iter_dialogs():
-                        if dialog.is_channel and dialog.id == channel_data['channel_id']:
-                            channel = dialog.entity
-                            logger.info(f"Found channel {channel_data['channel_id']} for folder '{folder_title}'")
-                            break
+                    # Resolve the channel directly instead of paging through all dialogs
+                    try:
+                        channel = await user_session.client.get_entity(
+                            PeerChannel(channel_data['channel_id'])
+                        )
+                        logger.info(f"Found channel {channel_data['channel_id']} for folder '{folder_title}'")
+                    except (ValueError, ChannelPrivateError):
+                        channel = None
                     
                     if channel:
                         # Проверяем, что мы все еще администратор канала
-                        if channel.admin_rights:
+                        if channel.creator or channel.admin_rights:
                             return channel
                         else:
                             logger.warning(f"Lost admin rights in channel {channel.id} for folder '{folder_title}', creating new one")
                     else:
-                        logger.warning(f"Channel {channel_data['channel_id']} for folder '{folder_title}' not found in dialogs, creating new one")
+                        logger.warning(f"Channel {channel_data['channel_id']} for folder '{folder_title}' not accessible, creating new one")
                         
                     # Удаляем старую информацию о канале
                     del folder_channels[folder_id_str]
-                    self.bot.session_manager.save_session(user_session.user_id, {
-                        'session_string': user_session.session_string,
-                        'active_folders': user_session.active_folders,
+                    await self.bot.session_manager.update_session(user_session.user_id, {
                         'folder_channels': folder_channels
                     })
                     
                 except Exception as e:
                     logger.error(f"Error getting existing channel for folder '{folder_title}': {e}")
             
-            # Create new channel
-            try:
-                result = await user_session.client(CreateChannelRequest(
-                    title=f"📁 {folder_title}",
-                    about=f"Aggregator for folder {folder_title}",
-                    megagroup=False
-                ))
-                
-                if not result or not result.chats:
-                    logger.error(f"Failed to create channel for folder '{folder_title}': Empty response")
-                    return None
-                    
-                channel = result.chats[0]
-                
-                # Verify channel creation
-                if not channel or not channel.id:
-                    logger.error(f"Failed to create channel for folder '{folder_title}': Invalid channel data")
-                    return None
-                
-                # Save channel info
-                folder_channels[folder_id_str] = {
-                    'channel_id': channel.id,
-                    'title': folder_title,
-                    'created_at': int(time.time())
-                }
-                self.bot.session_manager.save_session(user_session.user_id, {
-                    'session_string': user_session.session_string,
-                    'active_folders': user_session.active_folders,
-                    'folder_channels': folder_channels
-                })
-                
-                logger.info(f"Created new channel {channel.id} for folder '{folder_title}'")
-                return channel
+            # Create new channel, waiting out flood limits between attempts
+            for attempt in range(CREATE_CHANNEL_ATTEMPTS):
+                try:
+                    result = await user_session.client(CreateChannelRequest(
+                        title=f"📁 {folder_title}",
+                        about=f"Aggregator for folder {folder_title}",
+                        megagroup=False
+                    ))
+                    break
+                except FloodWaitError as e:
+                    logger.warning(f"FloodWaitError while creating channel for folder '{folder_title}': {e.seconds} seconds")
+                    if attempt == CREATE_CHANNEL_ATTEMPTS - 1:
+                        return None
+                    jitter = random.uniform(0, min(2 ** attempt, FLOOD_WAIT_MAX_JITTER))
+                    await asyncio.sleep(e.seconds + jitter)
+            
+            if not result or not result.chats:
+                logger.error(f"Failed to create channel for folder '{folder_title}': Empty response")
+                return None
                 
-            except FloodWaitError as e:
-                logger.warning(f"FloodWaitError while creating channel for folder '{folder_title}': {e.seconds} seconds")
-                await asyncio.sleep(e.seconds)
-                return await self.get_or_create_channel(user_session, folder)
+            channel = result.chats[0]
+            
+            # Verify channel creation
+            if not channel or not channel.id:
+                logger.error(f"Failed to create channel for folder '{folder_title}': Invalid channel data")
+                return None
+            
+            # Save channel info
+            folder_channels[folder_id_str] = {
+                'channel_id': channel.id,
+                'title': folder_title,
+                'created_at': int(time.time())
+            }
+            await self.bot.session_manager.update_session(user_session.user_id, {
+                'folder_channels': folder_channels
+            })
+            
+            logger.info(f"Created new channel {channel.id} for folder '{folder_title}'")
+            return channel
                 
         except Exception as e:
-            logger.error(f"Error in get_or_create_channel for folder '{self._get_folder_title(folder)}': {e}")
+            logger.error(f"Error in get_or_create_channel for folder '{folder_title}': {e}")
             return None
     
-    async def setup_message_forwarding(self, user_session, folder, channel_id):
+    async def setup_message_forwarding(self, user_session, folder, channel_id, folder_title=None):
         """Настройка пересылки сообщений для папки"""
-        folder_title = self._get_folder_title(folder)
+        if folder_title is None:
+            folder_title = self._get_folder_title(folder)
         logger.info(f"Настройка пересылки для папки '{folder_title}'")
         
         folder_id_str = str(folder.id)
         
-        # Удаляем существующий обработчик для этой папки, если есть
-        if folder_id_str in user_session.folder_handlers:
-            try:
-                old_handler = user_session.folder_handlers[folder_id_str]
-                user_session.client.remove_event_handler(old_handler)
-                logger.info(f"Удален старый обработчик для папки '{folder_title}'")
-            except Exception as e:
-                logger.error(f"Ошибка при удалении старого обработчика для папки '{folder_title}': {e}")
+        # Удаляем существующие маршруты для этой папки, если есть
+        self._remove_routes(user_session, folder_id_str)
         
-        # Кэшируем список peer_ids для папки
-        included_peers = []
+        # Кэшируем список peer_ids для папки, в том же виде, что event.chat_id
+        included_peers = set()
         for peer in folder.include_peers:
             try:
-                if hasattr(peer, 'channel_id'):
-                    included_peers.append(peer.channel_id)
-                elif hasattr(peer, 'chat_id'):
-                    included_peers.append(peer.chat_id)
-                elif hasattr(peer, 'user_id'):
-                    included_peers.append(peer.user_id)
+                included_peers.add(_peer_id(peer))
+            except TypeError:
+                # InputPeerSelf and similar carry no ID
+                continue
             except Exception as e:
                 logger.error(f"Ошибка при получении peer ID для папки '{folder_title}': {e}")
                 continue
@@ -311,63 +429,136 @@ class MessageHandlers:
         if not included_peers:
             logger.warning(f"Папка '{folder_title}' не содержит каналов")
             return
-            
-        async def forward_handler(event):
-            try:
-                if not event.message:
-                    return
-                    
-                if not await user_session.ensure_connected():
-                    logger.warning("Не удалось восстановить соединение")
-                    return
+        
+        included_peers = frozenset(included_peers)
+        user_session.folder_peers[folder_id_str] = included_peers
+        route = (channel_id, folder_title)
+        for chat_id in included_peers:
+            user_session.folder_routes.setdefault(chat_id, {})[folder_id_str] = route
+        
+        self.message_queue.start_processing(
+            channel_id,
+            partial(self._forward_batch, user_session, channel_id, folder_title)
+        )
+        
+        # Один обработчик на клиента для всех папок
+        if user_session.message_router is None:
+            user_session.message_router = partial(self._route_message, user_session)
+            user_session.client.add_event_handler(user_session.message_router, events.NewMessage())
+        logger.info(f"Настроены маршруты для папки '{folder_title}' с {len(included_peers)} каналами")
+    
+    def _remove_routes(self, user_session, folder_id_str):
+        """Stop routing messages to the folder's channel"""
+        routes = user_session.folder_routes
+        for chat_id in user_session.folder_peers.pop(folder_id_str, ()):
+            folders = routes.get(chat_id)
+            if folders is None:
+                continue
+            folders.pop(folder_id_str, None)
+            if not folders:
+                del routes[chat_id]
+        
+        if not routes and user_session.message_router is not None:
+            user_session.client.remove_event_handler(user_session.message_router)
+            user_session.message_router = None
+    
+    async def _route_message(self, user_session, event):
+        """Queue an incoming message for every folder channel its chat belongs to"""
+        try:
+            routes = user_session.folder_routes.get(event.chat_id)
+            if not routes or not event.message:
+                return
+                
+            if not await user_session.ensure_connected():
+                logger.warning("Не удалось восстановить соединение")
+                return
 
-                # Проверяем на дубликаты
-                if self._is_duplicate(event.message):
-                    logger.debug("Пропущено дублирующееся сообщение")
-                    return
+            # Проверяем на дубликаты
+            if self._is_duplicate(event.message):
+                logger.debug("Пропущено дублирующееся сообщение")
+                return
 
-                chat = await event.get_chat()
-                if not chat:
-                    return
-                    
-                logger.info(f"Получено сообщение из чата {chat.id} для папки '{folder_title}'")
+            log_info = logger.isEnabledFor(logging.INFO)
+            for channel_id, folder_title in routes.values():
+                if log_info:
+                    logger.info("Получено сообщение из чата %s для папки '%s'", event.chat_id, folder_title)
+                await self.message_queue.add_message(channel_id, event.message)
+            
+        except Exception as e:
+            # Tracebacks only when debugging, this runs for every message
+            logger.error(
+                "Ошибка при обработке сообщения из чата %s: %s", event.chat_id, e,
+                exc_info=logger.isEnabledFor(logging.DEBUG)
+            )
+    
+    def _get_forward_buckets(self, user_id, channel_id):
+        """Get rate limiters for forwarding into channel_id from the user's account"""
+        channel_bucket = self._channel_buckets.get(channel_id)
+        if channel_bucket is None:
+            rate = 1 / settings.FORWARD_DELAY if settings.FORWARD_DELAY > 0 else settings.FORWARD_RATE_LIMIT
+            channel_bucket = self._channel_buckets[channel_id] = AdaptiveTokenBucket(
+                rate=rate, capacity=1, max_rate=rate
+            )
+        return channel_bucket, self.get_user_bucket(user_id)
+    
+    def get_user_bucket(self, user_id):
+        """Get the rate limiter for API calls made from the user's account"""
+        # Flood limits are per account, one user's FloodWait must not slow others
+        user_bucket = self._user_buckets.get(user_id)
+        if user_bucket is None:
+            rate = settings.FORWARD_RATE_LIMIT
+            user_bucket = self._user_buckets[user_id] = AdaptiveTokenBucket(
+                rate=rate, capacity=max(1, int(rate)), max_rate=rate
+            )
+        return user_bucket
+    
+    async def _forward_batch(self, user_session, channel_id, folder_title, messages):
+        """Forward a batch of queued messages to the folder channel"""
+        channel_bucket, user_bucket = self._get_forward_buckets(user_session.user_id, channel_id)
+        
+        # Telethon sends one request per run of messages from the same chat,
+        # so keep each source chat's messages together
+        by_chat = {}
+        for message in messages:
+            by_chat.setdefault(message.chat_id, []).append(message)
+        if len(by_chat) > 1:
+            messages = [message for group in by_chat.values() for message in group]
+        
+        for attempt in range(FORWARD_ATTEMPTS):
+            try:
+                await channel_bucket.acquire()
+                # The bucket slows down and retries on short flood waits
+                await user_bucket.call(
+                    user_session.client.forward_messages,
+                    channel_id,
+                    messages,
+                    silent=True
+                )
+                logger.info("Переслано %s сообщений в канал %s папки '%s'", len(messages), channel_id, folder_title)
                 
-                if chat.id in included_peers:
-                    # Добавляем небольшую задержку для избежания флуда
-                    await asyncio.sleep(settings.FORWARD_DELAY)
-                    
-                    try:
-                        await user_session.client.forward_messages(
-                            channel_id,
-                            event.message,
-                            silent=True
-                        )
-                        logger.info(f"Сообщение успешно переслано в канал {channel_id} папки '{folder_title}'")
-                        
-                        # Обновляем метрики
-                        metrics.increment_forwarded_messages()
-                        
-                    except FloodWaitError as e:
-                        logger.warning(f"Флуд-ожидание {e.seconds} секунд для папки '{folder_title}'")
-                        await asyncio.sleep(e.seconds)
-                    except Exception as e:
-                        logger.error(f"Ошибка при пересылке для папки '{folder_title}': {e}")
-                        if "Could not find the input entity" in str(e):
-                            await user_session.init_client()
+                # Обновляем метрики
+                metrics.increment_forwarded_messages(len(messages))
+                return
                 
+            except FloodWaitError as e:
+                logger.warning("Флуд-ожидание %s секунд для папки '%s'", e.seconds, folder_title)
+                if attempt == FORWARD_ATTEMPTS - 1:
+                    # Don't hold up the channel's queue any longer
+                    logger.error("Пачка из %s сообщений для папки '%s' отброшена после %s попыток", len(messages), folder_title, FORWARD_ATTEMPTS)
+                    metrics.increment_failed_messages(len(messages))
+                    return
+                # Повторяем пачку после ожидания
+                jitter = random.uniform(0, min(2 ** attempt, FLOOD_WAIT_MAX_JITTER))
+                await asyncio.sleep(e.seconds + jitter)
             except Exception as e:
-                logger.error(f"Ошибка при обработке сообщения для папки '{folder_title}': {e}", exc_info=True)
-        
-        # Регистрируем новый обработчик с фильтром по чатам
-        handler = user_session.client.add_event_handler(
-            forward_handler,
-            events.NewMessage(chats=included_peers)
-        )
-        user_session.folder_handlers[folder_id_str] = handler
-        logger.info(f"Зарегистрирован новый обработчик для папки '{folder_title}' с {len(included_peers)} каналами")
+                logger.error("Ошибка при пересылке для папки '%s': %s", folder_title, e)
+                metrics.increment_failed_messages(len(messages))
+                if "Could not find the input entity" in str(e):
+                    await user_session.init_client()
+                return
     
-    async def start_auth_process(self, event, user_session):
-        """Начать процесс авторизации пользователя"""
+    async def _run_qr_login(self, event, user_session, intro_text, success_text, timeout_text, error_text, failure_text):
+        """Send a login QR code and wait until the user scans it"""
         try:
             # Инициализируем клиент с данными из настроек бота
             if not user_session.client:
@@ -382,67 +573,68 @@ class MessageHandlers:
             
             # Генерируем QR-код
             qr_login = await user_session.client.qr_login()
-            qr = qrcode.QRCode(version=1, box_size=10, border=5)
-            qr.add_data(qr_login.url)
-            qr.make(fit=True)
-            
-            # Создаем изображение QR-кода
-            img = qr.make_image(fill_color="black", back_color="white")
-            img_buffer = BytesIO()
-            img.save(img_buffer, format='PNG')
-            img_buffer.seek(0)
-            
-            # Отправляем приветствие и QR-код
-            welcome_text = (
-                "👋 Добро пожаловать в Smart Folders Bot!\n\n"
-                "📱 Для быстрой авторизации отсканируйте QR-код:\n"
-                "1. Откройте Telegram на телефоне\n"
-                "2. Перейдите в Настройки → Устройства\n"
-                "3. Нажмите 'Подключить устройство'\n"
-                "4. Отсканируйте QR-код\n\n"
-                "❓ Если не получается использовать QR-код, отправьте команду /manual для авторизации через API credentials"
-            )
+            img_buffer = BytesIO(await asyncio.to_thread(_make_qr_png, qr_login.url))
             
-            await event.respond(welcome_text, file=img_buffer)
+            # Отправляем QR-код и инструкции
+            await event.respond(intro_text, file=img_buffer)
             
             try:
                 # Ждем подтверждения авторизации
                 logger.info("Waiting for QR login confirmation...")
-                user = await qr_login.wait()
+                await qr_login.wait()
                 
                 # Сохраняем сессию
                 user_session.is_authorized = True
                 user_session.session_string = user_session.client.session.save()
-                self.bot.session_manager.save_session(user_session.user_id, {
+                await self.bot.session_manager.update_session(user_session.user_id, {
                     'session_string': user_session.session_string,
                     'active_folders': user_session.active_folders
                 })
                 
-                await event.respond("✅ Авторизация успешно завершена!")
+                await event.respond(success_text)
                 await self.show_folders(event, user_session)
                 
             except asyncio.TimeoutError:
                 logger.warning("QR login timeout")
-                await event.respond(
-                    "⚠️ Время ожидания истекло.\n"
-                    "Попробуйте еще раз отправив /start\n"
-                    "Или используйте ручную авторизацию через /manual"
-                )
+                await event.respond(timeout_text)
             except Exception as e:
                 logger.error(f"Error during QR login: {e}")
-                await event.respond(
-                    "❌ Ошибка при авторизации через QR-код.\n"
-                    "Попробуйте еще раз отправив /start\n"
-                    "Или используйте ручную авторизацию через /manual"
-                )
+                await event.respond(error_text)
                 
         except Exception as e:
             logger.error(f"Error in QR auth process: {e}")
-            await event.respond(
+            await event.respond(failure_text)
+    
+    async def start_auth_process(self, event, user_session):
+        """Начать процесс авторизации пользователя"""
+        await self._run_qr_login(
+            event, user_session,
+            intro_text=(
+                "👋 Добро пожаловать в Smart Folders Bot!\n\n"
+                "📱 Для быстрой авторизации отсканируйте QR-код:\n"
+                "1. Откройте Telegram на телефоне\n"
+                "2. Перейдите в Настройки → Устройства\n"
+                "3. Нажмите 'Подключить устройство'\n"
+                "4. Отсканируйте QR-код\n\n"
+                "❓ Если не получается использовать QR-код, отправьте команду /manual для авторизации через API credentials"
+            ),
+            success_text="✅ Авторизация успешно завершена!",
+            timeout_text=(
+                "⚠️ Время ожидания истекло.\n"
+                "Попробуйте еще раз отправив /start\n"
+                "Или используйте ручную авторизацию через /manual"
+            ),
+            error_text=(
+                "❌ Ошибка при авторизации через QR-код.\n"
+                "Попробуйте еще раз отправив /start\n"
+                "Или используйте ручную авторизацию через /manual"
+            ),
+            failure_text=(
                 "❌ Не удалось создать QR-код.\n"
                 "Пожалуйста, используйте ручную авторизацию:\n"
                 "Отправьте команду /manual"
             )
+        )
 
     async def handle_manual_auth(self, event, user_session):
         """Запуск процесса ручной авторизации через API credentials"""
@@ -464,78 +656,32 @@ class MessageHandlers:
         
         if choice == "1" or choice == "1️⃣":
             # QR-код
-            try:
-                # Инициализируем клиент с данными из настроек бота
-                if not user_session.client:
-                    user_session.client = TelegramClient(
-                        MemorySession(),
-                        api_id=settings.API_ID,
-                        api_hash=settings.API_HASH
-                    )
-                
-                if not user_session.client.is_connected():
-                    await user_session.client.connect()
-                
-                # Генерируем QR-код
-                qr_login = await user_session.client.qr_login()
-                qr = qrcode.QRCode(version=1, box_size=10, border=5)
-                qr.add_data(qr_login.url)
-                qr.make(fit=True)
-                
-                # Создаем изображение QR-кода
-                img = qr.make_image(fill_color="black", back_color="white")
-                img_buffer = BytesIO()
-                img.save(img_buffer, format='PNG')
-                img_buffer.seek(0)
-                
-                # Отправляем QR-код и инструкции
-                await event.respond(
+            await self._run_qr_login(
+                event, user_session,
+                intro_text=(
                     "📱 Отсканируйте этот QR-код в официальном приложении Telegram:\n\n"
                     "1. Откройте Telegram на телефоне\n"
                     "2. Перейдите в Настройки → Устройства\n"
                     "3. Нажмите 'Подключить устройство'\n"
-                    "4. Отсканируйте этот QR-код",
-                    file=img_buffer
-                )
-                
-                try:
-                    # Ждем подтверждения авторизации
-                    logger.info("Waiting for QR login confirmation...")
-                    user = await qr_login.wait()
-                    
-                    # Сохраняем сессию
-                    user_session.is_authorized = True
-                    user_session.session_string = user_session.client.session.save()
-                    self.bot.session_manager.save_session(user_session.user_id, {
-                        'session_string': user_session.session_string,
-                        'active_folders': user_session.active_folders
-                    })
-                    
-                    await event.respond("✅ Авторизация через QR-код успешно завершена!")
-                    await self.show_folders(event, user_session)
-                    
-                except asyncio.TimeoutError:
-                    logger.warning("QR login timeout")
-                    await event.respond(
-                        "⚠️ Время ожидания авторизации истекло.\n"
-                        "Попробуйте еще раз или используйте авторизацию через API credentials:\n"
-                        "/auth API_ID API_HASH"
-                    )
-                except Exception as e:
-                    logger.error(f"Error during QR login: {e}")
-                    await event.respond(
-                        "❌ Ошибка при авторизации через QR-код.\n"
-                        "Попробуйте использовать альтернативный способ:\n"
-                        "/auth API_ID API_HASH"
-                    )
-                
-            except Exception as e:
-                logger.error(f"Error creating QR code: {e}")
-                await event.respond(
+                    "4. Отсканируйте этот QR-код"
+                ),
+                success_text="✅ Авторизация через QR-код успешно завершена!",
+                timeout_text=(
+                    "⚠️ Время ожидания авторизации истекло.\n"
+                    "Попробуйте еще раз или используйте авторизацию через API credentials:\n"
+                    "/auth API_ID API_HASH"
+                ),
+                error_text=(
+                    "❌ Ошибка при авторизации через QR-код.\n"
+                    "Попробуйте использовать альтернативный способ:\n"
+                    "/auth API_ID API_HASH"
+                ),
+                failure_text=(
                     "❌ Не удалось создать QR-код.\n"
                     "Пожалуйста, используйте авторизацию через API credentials:\n"
                     "/auth API_ID API_HASH"
                 )
+            )
                 
         elif choice == "2" or choice == "2️⃣":
             # API credentials
@@ -1,49 +1,89 @@
+import atexit
+import itertools
 import logging
+import queue
 import sys
-import uuid
-from logging.handlers import RotatingFileHandler
+from logging.handlers import QueueHandler, QueueListener, RotatingFileHandler
 import os
 from .config import settings
 
+# Log-local IDs, next() on itertools.count is atomic under the GIL
+_request_ids = itertools.count()
+
 class RequestIDFilter(logging.Filter):
     def filter(self, record):
         if not hasattr(record, 'request_id'):
-            record.request_id = str(uuid.uuid4())[:8]
+            record.request_id = f"{next(_request_ids):08x}"
         return True
 
+# Shared by every logger set up below
+_FORMATTER = logging.Formatter(settings.LOG_FORMAT)
+_FILTER = RequestIDFilter()
+_console_handler = None
+_file_handlers = {}
+
+def _get_console_handler() -> logging.Handler:
+    global _console_handler
+    if _console_handler is None:
+        # Хендлер для консоли с поддержкой UTF-8
+        _console_handler = logging.StreamHandler(sys.stdout)
+        _console_handler.setFormatter(_FORMATTER)
+        _console_handler.setLevel(logging.INFO)
+        _console_handler.stream.reconfigure(encoding='utf-8')
+    return _console_handler
+
+def _get_file_handler(log_file: str) -> logging.Handler:
+    handler = _file_handlers.get(log_file)
+    if handler is None:
+        # Хендлер для файла с поддержкой UTF-8
+        handler = RotatingFileHandler(
+            log_file,
+            maxBytes=settings.LOG_MAX_SIZE,
+            backupCount=settings.LOG_BACKUP_COUNT,
+            encoding='utf-8'
+        )
+        handler.setFormatter(_FORMATTER)
+        handler.setLevel(logging.INFO)
+        _file_handlers[log_file] = handler
+    return handler
+
+class _FileQueueHandler(QueueHandler):
+    """Queue records for the listener thread, tagged with the log file they go to"""
+    
+    def __init__(self, file_handler: logging.Handler):
+        super().__init__(_log_queue)
+        self.file_handler = file_handler
+    
+    def prepare(self, record):
+        record = super().prepare(record)
+        record.file_handler = self.file_handler
+        return record
+
+class _FileRouter(logging.Handler):
+    """Write each record to the log file its logger was set up with"""
+    
+    def emit(self, record):
+        file_handler = record.file_handler
+        if record.levelno >= file_handler.level:
+            file_handler.handle(record)
+
+# Console and file writes happen on the listener thread, off the event loop
+_log_queue = queue.SimpleQueue()
+_listener = QueueListener(_log_queue, _get_console_handler(), _FileRouter(), respect_handler_level=True)
+_listener.start()
+atexit.register(_listener.stop)
+
 def setup_logger(name: str) -> logging.Logger:
     logger = logging.getLogger(name)
+    if logger.handlers:
+        # Already set up, don't open the log file again
+        return logger
     logger.setLevel(logging.INFO)
     
     # Add request ID filter
-    request_id_filter = RequestIDFilter()
-    logger.addFilter(request_id_filter)
-    
-    # Форматтер для логов
-    formatter = logging.Formatter(settings.LOG_FORMAT)
+    logger.addFilter(_FILTER)
     
-    # Хендлер для консоли с поддержкой UTF-8
-    console_handler = logging.StreamHandler(sys.stdout)
-    console_handler.setFormatter(formatter)
-    console_handler.setLevel(logging.INFO)
-    console_handler.stream.reconfigure(encoding='utf-8')
-    
-    # Хендлер для файла с поддержкой UTF-8
     log_file = os.path.join(settings.LOGS_DIR, f'{name.split(".")[-1]}.log')
-    file_handler = RotatingFileHandler(
-        log_file,
-        maxBytes=settings.LOG_MAX_SIZE,
-        backupCount=settings.LOG_BACKUP_COUNT,
-        encoding='utf-8'
-    )
-    file_handler.setFormatter(formatter)
-    file_handler.setLevel(logging.INFO)
-    
-    # Очищаем существующие хендлеры
-    logger.handlers.clear()
-    
-    # Добавляем новые хендлеры
-    logger.addHandler(console_handler)
-    logger.addHandler(file_handler)
+    logger.addHandler(_FileQueueHandler(_get_file_handler(log_file)))
     
-    return logger 
\ No newline at end of file
+    return logger
@@ -1,6 +1,7 @@
 import time
 from typing import Dict, Optional
 import asyncio
+import threading
 from aiohttp import web
 from prometheus_client import Counter, Histogram, Gauge, generate_latest
 from app.logger import setup_logger
@@ -8,6 +9,9 @@ from app.config import settings
 
 logger = setup_logger(__name__)
 
+# How long a rendered /metrics body is served again, shorter than any scrape interval
+METRICS_CACHE_TTL = 1.0
+
 # Define metrics
 message_forward_total = Counter(
     'telegram_message_forwards_total',
@@ -46,34 +50,64 @@ class MetricsCollector:
         self._server: Optional[web.Application] = None
         self._runner: Optional[web.AppRunner] = None
         self._site: Optional[web.TCPSite] = None
+        # The metrics server runs on its own loop so scrapes don't block forwarding
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._thread: Optional[threading.Thread] = None
+        # Labelled children looked up once, labels() hashes and locks on every call
+        self._forwards_success = message_forward_total.labels(status='success')
+        self._forwards_error = message_forward_total.labels(status='error')
+        self._queue_sizes: Dict[int, Gauge] = {}
+        self._cached_body = b''
+        self._cached_at = float('-inf')
     
     async def start(self):
         """Start metrics server if enabled"""
         if not settings.ENABLE_METRICS:
             return
         
+        self._loop = asyncio.new_event_loop()
+        self._thread = threading.Thread(target=self._run_loop, name='metrics', daemon=True)
+        self._thread.start()
         try:
-            app = web.Application()
-            app.router.add_get('/metrics', self._metrics_handler)
-            
-            self._server = app
-            self._runner = web.AppRunner(app)
-            await self._runner.setup()
-            
-            self._site = web.TCPSite(
-                self._runner,
-                settings.METRICS_HOST,
-                settings.METRICS_PORT
-            )
-            await self._site.start()
-            
+            await asyncio.wrap_future(asyncio.run_coroutine_threadsafe(self._start_server(), self._loop))
             logger.info(f"Metrics server started on {settings.METRICS_HOST}:{settings.METRICS_PORT}")
-            
         except Exception as e:
             logger.error(f"Failed to start metrics server: {e}")
     
+    def _run_loop(self):
+        asyncio.set_event_loop(self._loop)
+        self._loop.run_forever()
+        self._loop.close()
+    
+    async def _start_server(self):
+        app = web.Application()
+        app.router.add_get('/metrics', self._metrics_handler)
+        
+        self._server = app
+        self._runner = web.AppRunner(app)
+        await self._runner.setup()
+        
+        self._site = web.TCPSite(
+            self._runner,
+            settings.METRICS_HOST,
+            settings.METRICS_PORT
+        )
+        await self._site.start()
+    
     async def stop(self):
         """Stop metrics server"""
+        if self._loop is None:
+            return
+        
+        try:
+            await asyncio.wrap_future(asyncio.run_coroutine_threadsafe(self._stop_server(), self._loop))
+        finally:
+            self._loop.call_soon_threadsafe(self._loop.stop)
+            await asyncio.to_thread(self._thread.join)
+            self._loop = None
+            self._thread = None
+    
+    async def _stop_server(self):
         if self._site:
             await self._site.stop()
         if self._runner:
@@ -85,26 +119,49 @@ class MetricsCollector:
     
     async def _metrics_handler(self, request):
         """Handle metrics endpoint request"""
+        # Scrapes close together share one rendering; nothing here awaits,
+        # so concurrent requests on the metrics loop need no lock
+        now = time.monotonic()
+        if now - self._cached_at >= METRICS_CACHE_TTL:
+            # Gauges for plain counters are only needed when scraped
+            active_users.set(len(self.active_users))
+            active_folders.set(self.active_folders)
+            self._cached_body = generate_latest()
+            self._cached_at = now
         return web.Response(
-            body=generate_latest(),
+            body=self._cached_body,
             content_type='text/plain'
         )
     
-    def increment_forwarded_messages(self):
+    def increment_forwarded_messages(self, count=1):
         """Увеличить счетчик пересланных сообщений"""
-        self.forwarded_messages += 1
-        if self.forwarded_messages % 100 == 0:
-            logger.info(f"Всего переслано сообщений: {self.forwarded_messages}")
+        # Callers pass a whole batch, so the counter is touched once per batch
+        self._forwards_success.inc(count)
+        self.forwarded_messages += count
+    
+    def increment_failed_messages(self, count=1):
+        """Увеличить счетчик неудачных пересылок"""
+        self._forwards_error.inc(count)
+    
+    def update_queue_size(self, channel_id, size):
+        """Обновить размер очереди канала"""
+        gauge = self._queue_sizes.get(channel_id)
+        if gauge is None:
+            gauge = self._queue_sizes[channel_id] = queue_size.labels(channel_id=str(channel_id))
+        gauge.set(size)
+    
+    def remove_queue(self, channel_id):
+        """Убрать размер очереди остановленного канала"""
+        if self._queue_sizes.pop(channel_id, None) is not None:
+            queue_size.remove(str(channel_id))
     
     def update_active_folders(self, count):
         """Обновить количество активных папок"""
         self.active_folders = count
-        logger.info(f"Активных папок: {count}")
     
     def add_active_user(self, user_id):
         """Добавить активного пользователя"""
         self.active_users.add(user_id)
-        logger.info(f"Активных пользователей: {len(self.active_users)}")
     
     def increment_errors(self):
         """Увеличить счетчик ошибок"""
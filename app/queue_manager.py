@@ -1,50 +1,66 @@
 import asyncio
-from typing import Optional, Dict
+from collections import deque
+from typing import Deque, Optional, Dict
 from app.logger import setup_logger
 from app.config import settings
+from app.monitoring import metrics
 
 logger = setup_logger(__name__)
 
 class MessageQueue:
     def __init__(self):
-        self.queues: Dict[int, asyncio.Queue] = {}
+        self.queues: Dict[int, Deque] = {}
         self.tasks: Dict[int, asyncio.Task] = {}
         self._stop_events: Dict[int, asyncio.Event] = {}
+        # Set while the channel's queue has messages
+        self._ready: Dict[int, asyncio.Event] = {}
     
-    def get_queue(self, channel_id: int) -> asyncio.Queue:
+    def get_queue(self, channel_id: int) -> Deque:
         """Get or create queue for channel"""
-        if channel_id not in self.queues:
-            self.queues[channel_id] = asyncio.Queue(maxsize=settings.QUEUE_MAX_SIZE)
+        # Only touched from the event loop and never awaits, so no lock is needed
+        queue = self.queues.get(channel_id)
+        if queue is None:
+            queue = self.queues[channel_id] = deque()
             self._stop_events[channel_id] = asyncio.Event()
-        return self.queues[channel_id]
+            self._ready[channel_id] = asyncio.Event()
+        return queue
     
     async def add_message(self, channel_id: int, message):
-        """Add message to queue with timeout"""
+        """Add message to queue, dropping it if the queue is full"""
         try:
             queue = self.get_queue(channel_id)
-            await asyncio.wait_for(queue.put(message), timeout=settings.QUEUE_TIMEOUT)
-            logger.debug(f"Message added to queue for channel {channel_id}")
-        except asyncio.TimeoutError:
-            logger.warning(f"Queue is full for channel {channel_id}, message dropped")
+            if len(queue) >= settings.QUEUE_MAX_SIZE:
+                logger.warning(f"Queue is full for channel {channel_id}, message dropped")
+                return
+            queue.append(message)
+            self._ready[channel_id].set()
+            logger.debug("Message added to queue for channel %s", channel_id)
         except Exception as e:
             logger.error(f"Error adding message to queue: {e}")
     
     async def process_messages(self, channel_id: int, handler):
-        """Process messages from queue"""
+        """Process messages from queue, passing them to handler in batches"""
         queue = self.get_queue(channel_id)
+        ready = self._ready[channel_id]
         stop_event = self._stop_events[channel_id]
+        batch_size = settings.FORWARD_BATCH_SIZE
         
         while not stop_event.is_set():
             try:
-                message = await asyncio.wait_for(queue.get(), timeout=1.0)
+                if not queue:
+                    ready.clear()
+                    await ready.wait()
+                # Let messages arriving close together join the same batch,
+                # no need to wait when a full batch is already queued
+                if len(queue) < batch_size:
+                    await asyncio.sleep(settings.FORWARD_BATCH_WINDOW)
+                batch = [queue.popleft() for _ in range(min(len(queue), batch_size))]
+                # Once per batch rather than per message
+                metrics.update_queue_size(channel_id, len(queue))
                 try:
-                    await handler(message)
+                    await handler(batch)
                 except Exception as e:
-                    logger.error(f"Error processing message: {e}")
-                finally:
-                    queue.task_done()
-            except asyncio.TimeoutError:
-                continue
+                    logger.error("Error processing messages: %s", e)
             except Exception as e:
                 logger.error(f"Error in message processing loop: {e}")
                 await asyncio.sleep(1)
@@ -70,20 +86,25 @@ class MessageQueue:
         
         if channel_id in self.queues:
             del self.queues[channel_id]
+            del self._ready[channel_id]
+            metrics.remove_queue(channel_id)
             
         logger.info(f"Stopped message processing for channel {channel_id}")
     
     async def stop_all(self):
         """Stop all message processing"""
-        for channel_id in list(self.tasks.keys()):
+        # Snapshot before stop_processing removes entries from self.tasks
+        pending = list(self.tasks.items())
+        for channel_id, _ in pending:
             self.stop_processing(channel_id)
         
         # Wait for all tasks to complete
-        remaining_tasks = [t for t in self.tasks.values() if not t.done()]
+        remaining_tasks = [t for _, t in pending if not t.done()]
         if remaining_tasks:
             await asyncio.gather(*remaining_tasks, return_exceptions=True)
         
         self.queues.clear()
         self.tasks.clear()
         self._stop_events.clear()
+        self._ready.clear()
         logger.info("Stopped all message processing") 
\ No newline at end of file
@@ -0,0 +1,78 @@
+import asyncio
+from typing import Any, Awaitable, Callable
+from telethon.errors import FloodWaitError
+from app.logger import setup_logger
+from app.config import settings
+
+logger = setup_logger(__name__)
+
+class AdaptiveTokenBucket:
+    """Token bucket that speeds up on success and backs off on FloodWait"""
+    
+    def __init__(
+        self,
+        rate: float = 1.0,
+        capacity: int = 5,
+        min_rate: float = 0.1,
+        max_rate: float = 30.0,
+        increase_step: float = 0.5,
+        decrease_factor: float = 0.5,
+        max_retries: int = 3,
+        max_flood_wait: int = 300
+    ):
+        self.rate = rate
+        self.capacity = capacity
+        self.min_rate = min_rate
+        self.max_rate = max_rate
+        self.increase_step = increase_step
+        self.decrease_factor = decrease_factor
+        self.max_retries = max_retries
+        self.max_flood_wait = max_flood_wait
+        self.tokens = float(capacity)
+        self._updated_at = None
+        self._lock = asyncio.Lock()
+    
+    def _refill(self, now: float):
+        if self._updated_at is not None:
+            self.tokens = min(self.capacity, self.tokens + (now - self._updated_at) * self.rate)
+        self._updated_at = now
+    
+    async def acquire(self):
+        """Wait until a token is available and take it"""
+        # Lock keeps waiters in FIFO order
+        async with self._lock:
+            loop = asyncio.get_running_loop()
+            while True:
+                self._refill(loop.time())
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+    
+    def increase_rate(self):
+        """Additive increase after a successful call"""
+        self.rate = min(self.max_rate, self.rate + self.increase_step)
+    
+    def decrease_rate(self):
+        """Multiplicative decrease after a FloodWait"""
+        self.rate = max(self.min_rate, self.rate * self.decrease_factor)
+        logger.warning("Telegram rate limited, request rate lowered to %.2f/s", self.rate)
+    
+    async def call(self, func: Callable[..., Awaitable[Any]], *args, **kwargs) -> Any:
+        """Run a Telegram API call under the rate limit, retrying on FloodWait"""
+        for attempt in range(self.max_retries):
+            await self.acquire()
+            try:
+                result = await func(*args, **kwargs)
+            except FloodWaitError as e:
+                self.decrease_rate()
+                # Long waits and the last attempt are left to the caller
+                if attempt == self.max_retries - 1 or e.seconds > self.max_flood_wait:
+                    raise
+                await asyncio.sleep(e.seconds)
+            else:
+                self.increase_rate()
+                return result
+
+# Bucket for the bot account's own API calls, user accounts get their own
+telegram_bucket = AdaptiveTokenBucket(capacity=settings.RATE_LIMIT_BURST)
@@ -1,16 +1,41 @@
 from telethon import TelegramClient
 from telethon.sessions import StringSession
 from telethon.tl.types import TextWithEntities
+import asyncio
 import json
 import os
 import time
 import functools
+from typing import Dict, List, Tuple
 from cryptography.fernet import Fernet
 from .config import settings
 from .logger import setup_logger
 
+try:
+    import orjson
+except ImportError:  # orjson is optional, fall back to stdlib json
+    orjson = None
+
 logger = setup_logger(__name__)
 
+def _default(obj):
+    """Convert Telethon objects to JSON-serializable values, called only for unknown types"""
+    if isinstance(obj, TextWithEntities):
+        return str(obj)
+    if hasattr(obj, 'to_dict'):
+        return obj.to_dict()
+    raise TypeError(f"Object of type {type(obj).__name__} is not JSON serializable")
+
+def _dumps(data) -> bytes:
+    if orjson is not None:
+        return orjson.dumps(data, default=_default, option=orjson.OPT_NON_STR_KEYS)
+    return json.dumps(data, default=_default).encode()
+
+def _loads(raw: bytes):
+    if orjson is not None:
+        return orjson.loads(raw)
+    return json.loads(raw.decode())
+
 def circuit_breaker(max_failures=5, reset_timeout=300):
     def decorator(func):
         failures = 0
@@ -44,30 +69,34 @@ class SessionManager:
     def __init__(self):
         self.storage_dir = os.path.join(settings.DATA_DIR, 'user_data')
         self.encryption_key = settings.ENCRYPTION_KEY.encode() if settings.ENCRYPTION_KEY else None
+        # Encrypted data waiting for the background writer, newest per user
+        self._pending: Dict[int, bytes] = {}
+        self._save_queue: asyncio.Queue = asyncio.Queue(maxsize=settings.QUEUE_MAX_SIZE)
+        self._queued = set()
+        self._writer_running = False
+        # Last serialized data per user, to skip saves that change nothing
+        self._last_saved: Dict[int, bytes] = {}
+        # Updated data waiting for SESSION_SAVE_DELAY before being saved
+        self._dirty: Dict[int, dict] = {}
+        self._dirty_handles: Dict[int, asyncio.TimerHandle] = {}
     
-    def _serialize_data(self, data):
-        """Convert Telethon objects to JSON-serializable format"""
-        if isinstance(data, dict):
-            return {k: self._serialize_data(v) for k, v in data.items()}
-        elif isinstance(data, list):
-            return [self._serialize_data(item) for item in data]
-        elif isinstance(data, TextWithEntities):
-            return str(data)
-        elif hasattr(data, 'to_dict'):
-            return data.to_dict()
-        return data
-        
-    def _encrypt_data(self, data: dict) -> bytes:
+    def _encode_data(self, data: dict) -> bytes:
+        return _dumps(data)
+    
+    def _encrypt_bytes(self, raw: bytes) -> bytes:
         if not self.encryption_key:
-            return json.dumps(self._serialize_data(data)).encode()
+            return raw
         f = Fernet(self.encryption_key)
-        return f.encrypt(json.dumps(self._serialize_data(data)).encode())
+        return f.encrypt(raw)
+    
+    def _encrypt_data(self, data: dict) -> bytes:
+        return self._encrypt_bytes(self._encode_data(data))
     
     def _decrypt_data(self, encrypted_data: bytes) -> dict:
         if not self.encryption_key:
-            return json.loads(encrypted_data.decode())
+            return _loads(encrypted_data)
         f = Fernet(self.encryption_key)
-        return json.loads(f.decrypt(encrypted_data).decode())
+        return _loads(f.decrypt(encrypted_data))
     
     async def create_client(self, session_string=None) -> TelegramClient:
         client = TelegramClient(
@@ -87,26 +116,157 @@ class SessionManager:
         await client.connect()
         return client
     
+    def _write_session(self, user_id: int, encrypted_data: bytes):
+        file_path = os.path.join(self.storage_dir, f'{user_id}.session')
+        with open(file_path, 'wb') as f:
+            f.write(encrypted_data)
+        os.chmod(file_path, 0o600)  # Secure file permissions
+    
     def save_session(self, user_id: int, data: dict):
         try:
-            file_path = os.path.join(self.storage_dir, f'{user_id}.session')
-            encrypted_data = self._encrypt_data(data)
-            with open(file_path, 'wb') as f:
-                f.write(encrypted_data)
-            os.chmod(file_path, 0o600)  # Secure file permissions
+            raw = self._encode_data(data)
+            self._write_session(user_id, self._encrypt_bytes(raw))
+            self._last_saved[user_id] = raw
             logger.info(f"Session data saved for user {user_id}")
         except Exception as e:
             logger.error(f"Error saving session for user {user_id}: {e}")
             raise
     
+    def queue_save(self, user_id: int, data: dict):
+        """Hand session data to the background writer, writing inline if it can't take it"""
+        # Full data replaces any updates still waiting to be saved
+        self._drop_dirty(user_id)
+        # Serialize now so later changes to the caller's dicts are not picked up
+        raw = self._encode_data(data)
+        if self._last_saved.get(user_id) == raw:
+            return
+        encrypted_data = self._encrypt_bytes(raw)
+        if not self._writer_running:
+            self._write_session(user_id, encrypted_data)
+            self._last_saved[user_id] = raw
+            return
+        
+        self._last_saved[user_id] = raw
+        self._pending[user_id] = encrypted_data
+        if user_id in self._queued:
+            # Already queued, the writer takes the newest data
+            return
+        try:
+            self._save_queue.put_nowait(user_id)
+            self._queued.add(user_id)
+        except asyncio.QueueFull:
+            del self._pending[user_id]
+            self._last_saved.pop(user_id, None)
+            self._write_session(user_id, encrypted_data)
+            self._last_saved[user_id] = raw
+    
+    def _data_in_memory(self, user_id: int):
+        """Newest session data held in memory, None if it has to be read from disk"""
+        data = self._dirty.get(user_id)
+        if data is None:
+            # The last saved data is already in memory for users saved in this process
+            raw = self._last_saved.get(user_id)
+            if raw is not None:
+                data = _loads(raw)
+        return data
+    
+    async def update_session(self, user_id: int, changes: dict):
+        """Save only the given top-level keys, keeping the rest of the stored data"""
+        data = self._data_in_memory(user_id)
+        if data is None:
+            loaded = await asyncio.to_thread(self.load_session, user_id)
+            # Another update may have landed while the file was read
+            data = self._data_in_memory(user_id)
+            if data is None:
+                data = loaded
+        data.update(changes)
+        if not self._writer_running:
+            self.queue_save(user_id, data)
+            return
+        
+        # Collect updates made in quick succession into one save
+        self._dirty[user_id] = data
+        if user_id not in self._dirty_handles:
+            loop = asyncio.get_running_loop()
+            self._dirty_handles[user_id] = loop.call_later(
+                settings.SESSION_SAVE_DELAY, self._save_dirty, user_id
+            )
+    
+    def _save_dirty(self, user_id: int):
+        self._dirty_handles.pop(user_id, None)
+        data = self._dirty.pop(user_id, None)
+        if data is None:
+            return
+        try:
+            self.queue_save(user_id, data)
+        except Exception as e:
+            logger.error(f"Error saving session for user {user_id}: {e}")
+    
+    def _drop_dirty(self, user_id: int):
+        handle = self._dirty_handles.pop(user_id, None)
+        if handle is not None:
+            handle.cancel()
+        self._dirty.pop(user_id, None)
+    
+    def save_many(self, batch: List[Tuple[int, bytes]]):
+        """Write a batch of encrypted sessions, safe to call from a worker thread"""
+        for user_id, encrypted_data in batch:
+            try:
+                self._write_session(user_id, encrypted_data)
+            except Exception as e:
+                # Let the next save of the same data try again
+                self._last_saved.pop(user_id, None)
+                logger.error(f"Error saving session for user {user_id}: {e}")
+    
+    async def run_writer(self):
+        """Write queued sessions in batches of BATCH_SIZE"""
+        loop = asyncio.get_running_loop()
+        queue = self._save_queue
+        self._writer_running = True
+        try:
+            while True:
+                user_ids = [await queue.get()]
+                while len(user_ids) < settings.BATCH_SIZE and not queue.empty():
+                    user_ids.append(queue.get_nowait())
+                self._queued.difference_update(user_ids)
+                
+                batch = [(user_id, self._pending[user_id]) for user_id in user_ids]
+                await loop.run_in_executor(None, self.save_many, batch)
+                
+                # Keep data that was queued again while writing
+                for user_id, encrypted_data in batch:
+                    if self._pending.get(user_id) is encrypted_data:
+                        del self._pending[user_id]
+                logger.debug(f"Saved {len(batch)} sessions")
+        finally:
+            self._writer_running = False
+            self.flush()
+    
+    def flush(self):
+        """Write all pending sessions synchronously"""
+        for user_id in list(self._dirty):
+            self._save_dirty(user_id)
+        for handle in self._dirty_handles.values():
+            handle.cancel()
+        self._dirty_handles.clear()
+        batch = list(self._pending.items())
+        self._pending.clear()
+        self._queued.clear()
+        while not self._save_queue.empty():
+            self._save_queue.get_nowait()
+        self.save_many(batch)
+    
     def load_session(self, user_id: int) -> dict:
         try:
-            file_path = os.path.join(self.storage_dir, f'{user_id}.session')
-            if not os.path.exists(file_path):
-                return {'active_folders': {}, 'folder_channels': {}}
-            
-            with open(file_path, 'rb') as f:
-                encrypted_data = f.read()
+            # Data not yet written by the background writer is the newest
+            encrypted_data = self._pending.get(user_id)
+            if encrypted_data is None:
+                file_path = os.path.join(self.storage_dir, f'{user_id}.session')
+                if not os.path.exists(file_path):
+                    return {'active_folders': {}, 'folder_channels': {}}
+                
+                with open(file_path, 'rb') as f:
+                    encrypted_data = f.read()
             
             data = self._decrypt_data(encrypted_data)
             logger.info(f"Session data loaded for user {user_id}")
@@ -115,6 +275,18 @@ class SessionManager:
             logger.error(f"Error loading session for user {user_id}: {e}")
             return {'active_folders': {}, 'folder_channels': {}}
     
+    async def load_session_async(self, user_id: int) -> dict:
+        """Load session data without blocking the event loop"""
+        data = self._dirty.get(user_id)
+        if data is not None:
+            # Copy so callers can change the result without touching unsaved data
+            return {k: dict(v) if isinstance(v, dict) else v for k, v in data.items()}
+        # Data saved in this process is already in memory
+        raw = self._last_saved.get(user_id)
+        if raw is not None:
+            return _loads(raw)
+        return await asyncio.to_thread(self.load_session, user_id)
+    
     @circuit_breaker(max_failures=5, reset_timeout=300)
     async def ensure_connected(self, client: TelegramClient) -> bool:
         if not client or not client.is_connected():
@@ -123,10 +295,10 @@ class SessionManager:
     
     async def cleanup_session(self, user_id: int):
         try:
-            data = self.load_session(user_id)
+            data = await self.load_session_async(user_id)
             # Clear session string but keep folder data
             data['session_string'] = None
-            self.save_session(user_id, data)
+            self.queue_save(user_id, data)
             logger.info(f"Session cleaned up for user {user_id}")
         except Exception as e:
             logger.error(f"Error cleaning up session for user {user_id}: {e}")
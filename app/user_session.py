@@ -1,24 +1,39 @@
 from telethon import TelegramClient
 from telethon.sessions import StringSession
-from telethon.errors import FloodWaitError
+from telethon.errors import ChannelPrivateError, FloodWaitError
 from telethon.tl.functions.messages import GetDialogFiltersRequest
-from telethon.tl.types import DialogFilter
+from telethon.tl.types import DialogFilter, PeerChannel
 import logging
 import asyncio
+import time
 from app.logger import setup_logger
 from app.config import settings
 
 logger = setup_logger(__name__)
 
 class UserSession:
+    __slots__ = (
+        'user_id', 'bot', 'client', '_is_authorized', 'session_string',
+        'active_folders', 'folder_routes', 'folder_peers', 'message_router', 'last_activity',
+        'disconnect_watcher',
+        'api_id', 'api_hash', 'phone',
+        'awaiting_auth_choice', 'awaiting_phone', 'awaiting_code',
+    )
+    
     def __init__(self, user_id: int, bot):
         self.user_id = user_id
         self.bot = bot
         self.client = None
-        self.is_authorized = False
+        self._is_authorized = False
         self.session_string = None
         self.active_folders = {}
-        self.folder_handlers = {}
+        # chat_id -> {folder_id: (channel_id, folder_title)} for message forwarding
+        self.folder_routes = {}
+        # folder_id -> frozenset of chat IDs routed for that folder
+        self.folder_peers = {}
+        self.message_router = None
+        self.last_activity = time.monotonic()
+        self.disconnect_watcher = None
         
         # Auth fields
         self.api_id = None
@@ -28,10 +43,30 @@ class UserSession:
         self.awaiting_phone = False
         self.awaiting_code = False
     
+    @property
+    def is_authorized(self) -> bool:
+        return self._is_authorized
+    
+    @is_authorized.setter
+    def is_authorized(self, value: bool):
+        """Keep the bot's authorized user count and connection checks in sync"""
+        value = bool(value)
+        if value != self._is_authorized:
+            self.bot.authorized_count += 1 if value else -1
+        self._is_authorized = value
+        if value:
+            self.bot.schedule_connection_check(self.user_id)
+    
     async def init_client(self) -> bool:
         """Initialize user client with improved error handling"""
         try:
-            if self.session_string:
+            if self.client:
+                # Reuse the existing client so its connection and event handlers survive
+                if self.client.is_connected():
+                    # A disconnect we make ourselves must not trigger another check
+                    self.bot.unwatch_disconnect(self)
+                    await self.client.disconnect()
+            elif self.session_string:
                 # Try to restore from saved session
                 self.client = TelegramClient(
                     StringSession(self.session_string),
@@ -48,6 +83,7 @@ class UserSession:
             
             if not self.client.is_connected():
                 await self.client.connect()
+            self.bot.watch_disconnect(self)
             
             return True
             
@@ -79,7 +115,7 @@ class UserSession:
                 logger.error("Failed to establish connection for channel restoration")
                 return
             
-            data = self.bot.session_manager.load_session(self.user_id)
+            data = await self.bot.session_manager.load_session_async(self.user_id)
             folder_channels = data.get('folder_channels', {})
             
             # Get current folders
@@ -87,7 +123,7 @@ class UserSession:
             current_folders = {
                 str(f.id): f 
                 for f in dialog_filters.filters 
-                if isinstance(f, DialogFilter) and hasattr(f, 'id') and hasattr(f, 'title')
+                if isinstance(f, DialogFilter)
             }
             
             # Restore active folders
@@ -97,17 +133,13 @@ class UserSession:
                     try:
                         channel_id = channel_data['channel_id']
                         
-                        # Try to get channel through dialogs first
-                        channel = None
-                        async for dialog in self.client.iter_dialogs():
-                            if dialog.is_channel and dialog.id == channel_id:
-                                channel = dialog.entity
-                                logger.info(f"Found channel {channel_id} in dialogs")
-                                break
-                        
-                        if not channel:
-                            logger.warning(f"Channel {channel_id} not found in dialogs, skipping")
+                        # Resolve the channel directly instead of paging through all dialogs
+                        try:
+                            channel = await self.client.get_entity(PeerChannel(channel_id))
+                        except (ValueError, ChannelPrivateError):
+                            logger.warning(f"Channel {channel_id} not accessible, skipping")
                             continue
+                        logger.info(f"Found channel {channel_id}")
                         
                         self.active_folders[folder_id] = {
                             'channel_id': channel.id,
@@ -123,7 +155,7 @@ class UserSession:
                             self.active_folders[folder_id] = channel_data
             
             # Save updated data
-            self.bot.session_manager.save_session(self.user_id, {
+            self.bot.session_manager.queue_save(self.user_id, {
                 'session_string': self.session_string,
                 'active_folders': self.active_folders,
                 'folder_channels': folder_channels
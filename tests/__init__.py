@@ -0,0 +1,8 @@
+import os
+import tempfile
+
+# Settings are read at import, give the app a throwaway environment
+os.environ.setdefault('API_ID', '1')
+os.environ.setdefault('API_HASH', 'test')
+os.environ.setdefault('BOT_TOKEN', 'test')
+os.environ.setdefault('DATA_DIR', tempfile.mkdtemp(prefix='smart-folders-test-'))
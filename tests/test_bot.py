@@ -0,0 +1,112 @@
+import asyncio
+import time
+import unittest
+
+from app.bot import TelegramBot
+from app.config import settings
+from app.handlers import MessageHandlers
+from app.user_session import UserSession
+
+
+class FakeClient:
+    def __init__(self):
+        self.disconnected = False
+    
+    async def disconnect(self):
+        self.disconnected = True
+
+
+class FakeSession:
+    def __init__(self, idle_for: float, is_authorized: bool = False):
+        self.client = FakeClient()
+        self.is_authorized = is_authorized
+        self.last_activity = time.monotonic() - idle_for
+
+
+class IdleSessionEvictionTest(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        self.bot = TelegramBot()
+    
+    async def asyncTearDown(self):
+        await self.bot.stop()
+    
+    async def test_connection_check_loop_evicts_idle_sessions(self):
+        idle = FakeSession(idle_for=settings.SESSION_TIMEOUT + 60)
+        authorized = FakeSession(idle_for=settings.SESSION_TIMEOUT + 60, is_authorized=True)
+        active = FakeSession(idle_for=0)
+        self.bot.users[1] = idle
+        self.bot.users[2] = authorized
+        self.bot.users[3] = active
+        
+        self.bot._connection_checker = asyncio.create_task(self.bot.check_connections())
+        # Let the loop run its first pass and the background disconnect finish
+        for _ in range(3):
+            await asyncio.sleep(0)
+        
+        self.assertNotIn(1, self.bot.users)
+        self.assertTrue(idle.client.disconnected)
+        # Authorized and recently active sessions stay
+        self.assertIs(self.bot.users[2], authorized)
+        self.assertIs(self.bot.users[3], active)
+        self.assertFalse(authorized.client.disconnected)
+
+
+class BrokenClient:
+    """Connects fine but fails every request, like a client with a broken session"""
+    
+    def __init__(self):
+        self.connects = 0
+        self._connected = False
+        self._disconnected = None
+    
+    def is_connected(self):
+        return self._connected
+    
+    @property
+    def disconnected(self):
+        return self._disconnected
+    
+    async def connect(self):
+        self.connects += 1
+        self._connected = True
+        self._disconnected = asyncio.get_running_loop().create_future()
+    
+    async def disconnect(self):
+        self._connected = False
+        if not self._disconnected.done():
+            self._disconnected.set_result(None)
+    
+    async def is_user_authorized(self):
+        return True
+    
+    async def get_me(self):
+        raise ConnectionError("broken")
+
+
+class ConnectionCheckBackoffTest(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        self.bot = TelegramBot()
+        self.bot.handlers = MessageHandlers(self.bot)
+    
+    async def asyncTearDown(self):
+        await self.bot.stop()
+    
+    async def test_failing_session_is_rechecked_after_flaky_interval(self):
+        client = BrokenClient()
+        session = self.bot.users[1] = UserSession(1, self.bot)
+        session.client = client
+        await session.init_client()
+        session.is_authorized = True
+        
+        self.bot._connection_checker = asyncio.create_task(self.bot.check_connections())
+        await asyncio.sleep(0.2)
+        
+        # One reconnect by the failed check, none caused by its own disconnect
+        self.assertEqual(client.connects, 2)
+        loop = asyncio.get_running_loop()
+        next_check = self.bot._check_scheduled[1] - loop.time()
+        self.assertGreaterEqual(next_check, settings.CONNECTION_CHECK_INTERVAL - 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
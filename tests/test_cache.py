@@ -0,0 +1,77 @@
+import gzip
+import pickle
+import unittest
+
+from app.cache import AsyncLRUCache, async_cached
+
+
+class FakeRedis:
+    def __init__(self):
+        self.data = {}
+    
+    async def get(self, key):
+        return self.data.get(key)
+    
+    async def setex(self, key, ttl, value):
+        self.data[key] = value
+
+
+class AsyncCachedKeyTest(unittest.IsolatedAsyncioTestCase):
+    async def test_fresh_lists_are_keyed_by_contents(self):
+        calls = []
+        
+        @async_cached(ttl=60)
+        async def total(items):
+            calls.append(list(items))
+            return sum(items)
+        
+        # Lists freed each iteration may reuse the same id()
+        for i in range(200):
+            self.assertEqual(await total([i, i]), 2 * i)
+        self.assertEqual(len(calls), 200)
+        
+        # Distinct lists with equal contents share one entry
+        self.assertEqual(await total([5, 5]), 10)
+        self.assertEqual(len(calls), 200)
+    
+    async def test_nested_containers_are_keyed_by_contents(self):
+        @async_cached(ttl=60)
+        async def first(mapping):
+            return mapping['a'][0]
+        
+        self.assertEqual(await first({'a': [1]}), 1)
+        self.assertEqual(await first({'a': [2]}), 2)
+    
+    async def test_unhashable_objects_are_not_cached(self):
+        class Unhashable:
+            __hash__ = None
+            
+            def __init__(self, value):
+                self.value = value
+        
+        @async_cached(ttl=60)
+        async def value_of(obj):
+            return obj.value
+        
+        self.assertEqual(await value_of(Unhashable(1)), 1)
+        self.assertEqual(await value_of(Unhashable(2)), 2)
+
+
+class RemoteCacheTest(unittest.IsolatedAsyncioTestCase):
+    async def test_round_trip(self):
+        cache = AsyncLRUCache(60)
+        cache.redis = FakeRedis()
+        await cache.set_remote(('f', (1,)), {'a': 1})
+        cache.cache.clear()
+        self.assertEqual(await cache.get_remote(('f', (1,))), {'a': 1})
+    
+    async def test_unsigned_value_is_not_unpickled(self):
+        cache = AsyncLRUCache(60)
+        cache.redis = FakeRedis()
+        payload = gzip.compress(pickle.dumps('forged'))
+        cache.redis.data["cache:('f', (1,))"] = b'\0' * 32 + payload
+        self.assertIsNone(await cache.get_remote(('f', (1,))))
+
+
+if __name__ == '__main__':
+    unittest.main()
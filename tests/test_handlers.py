@@ -0,0 +1,38 @@
+import unittest
+from types import SimpleNamespace
+from unittest import mock
+
+from telethon.errors import FloodWaitError
+
+from app.handlers import FORWARD_ATTEMPTS, MessageHandlers
+from app.monitoring import metrics
+
+
+class FloodedClient:
+    def __init__(self):
+        self.calls = 0
+    
+    async def forward_messages(self, *args, **kwargs):
+        self.calls += 1
+        raise FloodWaitError(request=None, capture=0)
+
+
+class ForwardBatchTest(unittest.IsolatedAsyncioTestCase):
+    async def test_flooded_batch_is_dropped_after_capped_retries(self):
+        handlers = MessageHandlers(None)
+        client = FloodedClient()
+        session = SimpleNamespace(user_id=1, client=client)
+        messages = [SimpleNamespace(chat_id=10, id=i) for i in range(3)]
+        
+        with mock.patch('app.handlers.random.uniform', return_value=0), \
+                mock.patch.object(metrics, 'increment_failed_messages') as failed:
+            await handlers._forward_batch(session, 100, 'Folder', messages)
+        
+        # Each attempt goes through the bucket's own retries
+        bucket = handlers.get_user_bucket(1)
+        self.assertEqual(client.calls, FORWARD_ATTEMPTS * bucket.max_retries)
+        failed.assert_called_once_with(len(messages))
+
+
+if __name__ == '__main__':
+    unittest.main()